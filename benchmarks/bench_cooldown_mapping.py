@@ -0,0 +1,73 @@
+"""
+Benchmark of cooldown bucket lookups with many live buckets, scanning all buckets for expired ones
+on every lookup against expiring them by a heap.
+Run from the repository root: python benchmarks/bench_cooldown_mapping.py
+"""
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "free_smiley_dealer"))
+
+from discord.ext import commands
+
+import cogs.smileydealer  # Imported before extensions, for the import order of the bot
+from extensions import CooldownMapping
+
+BUCKETS_COUNTS = (10_000, 100_000)
+LOOKUPS_COUNT = 1000
+PER = 60
+
+
+class ScanningCooldownMapping(CooldownMapping):
+    """
+    The former expiry, a scan of all the buckets.
+    """
+
+    def _verify_cache_integrity(self, current=None):
+        current = current or time.time()
+        dead_keys = [k for k, v in self._cache.items() if current > v._last + v.per]
+        for k in dead_keys:
+            del self._cache[k]
+
+
+def make_message(user_id: int):
+    return SimpleNamespace(author=SimpleNamespace(id=user_id))
+
+
+def make_filled_mapping(buckets_count: int, now: float) -> CooldownMapping:
+    mapping = CooldownMapping(commands.Cooldown(1, PER), commands.BucketType.user)
+    for user_id in range(buckets_count):
+        # Used at some point in the last cooldown window
+        current = now - random.uniform(0, PER / 2)
+        mapping.get_bucket(make_message(user_id), current).update_rate_limit(current)
+    return mapping
+
+
+def measure(mapping_type, buckets_count: int) -> float:
+    random.seed(0)
+    now = time.time()
+    # Filled with the heap expiry, filling with scans takes quadratic time
+    mapping = make_filled_mapping(buckets_count, now)
+    mapping.__class__ = mapping_type
+
+    messages = [make_message(random.randrange(buckets_count * 2)) for _ in range(LOOKUPS_COUNT)]
+    t0 = time.perf_counter()
+    for message in messages:
+        mapping.get_bucket(message, now).update_rate_limit(now)
+    return (time.perf_counter() - t0) / LOOKUPS_COUNT
+
+
+def main():
+    for buckets_count in BUCKETS_COUNTS:
+        scanning_time = measure(ScanningCooldownMapping, buckets_count)
+        heap_time = measure(CooldownMapping, buckets_count)
+        print(f"{buckets_count:>7} live buckets: "
+              f"scan {scanning_time * 1e6:9.1f} us/lookup, "
+              f"heap {heap_time * 1e6:6.1f} us/lookup ({scanning_time / heap_time:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
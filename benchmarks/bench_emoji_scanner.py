@@ -0,0 +1,73 @@
+"""
+Benchmark of the smiley index scanner against the `emojis.iter` path it replaced.
+Run from the repository root: python benchmarks/bench_emoji_scanner.py
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "free_smiley_dealer"))
+
+import emojis
+
+from cogs.smileydealer.core import SCANNED_EMOJI_UNICODE_TO_NAME
+from cogs.smileydealer.matching import SmileyIndex
+
+MAX_SMILEYS = 10
+REPEAT = 5
+
+
+def make_index() -> SmileyIndex:
+    # About as many smileys as the real registry has
+    random.seed(0)
+    smiley_emoji_names = random.sample(sorted(set(SCANNED_EMOJI_UNICODE_TO_NAME.values())), 300)
+    smiley_emojis = {name: [f"<:{name}_1:1>"] for name in smiley_emoji_names}
+    return SmileyIndex(SCANNED_EMOJI_UNICODE_TO_NAME, [], smiley_emojis)
+
+
+def make_messages(index: SmileyIndex):
+    random.seed(1)
+    words = "the quick brown fox jumps over the lazy dog 2 times on friday".split()
+    smiley_unicodes = list(index.smileys)
+
+    plain_paste = ' '.join(random.choices(words, k=4000))
+    return {
+        "short plain text": "hey, what's up? see you at 8",
+        "short with emoji": f"lol {smiley_unicodes[0]} that's great",
+        "plain paste (~20k chars)": plain_paste,
+        "paste ending with emojis": plain_paste + ' '.join(smiley_unicodes[:MAX_SMILEYS]),
+        "emoji heavy paste": ' '.join(random.choices(smiley_unicodes, k=2000)),
+    }
+
+
+def scan_with_emojis_iter(index: SmileyIndex, message: str):
+    smileys = {}
+    for smiley in map(index.get, emojis.iter(message)):
+        if smiley and smiley[0] not in smileys:
+            smileys[smiley[0]] = smiley
+            if len(smileys) == MAX_SMILEYS:
+                break
+    return list(smileys.values())
+
+
+def scan_with_index(index: SmileyIndex, message: str):
+    return index.scan(message, MAX_SMILEYS)
+
+
+def main():
+    index = make_index()
+
+    print(f"{'message':<28}{'emojis.iter':>16}{'index.scan':>16}{'speedup':>10}")
+    for name, message in make_messages(index).items():
+        number = max(1, 20_000 // len(message))
+        results = []
+        for scan in (scan_with_emojis_iter, scan_with_index):
+            best = min(timeit.repeat(lambda: scan(index, message), number=number, repeat=REPEAT))
+            results.append(best / number * 1e6)
+
+        print(f"{name:<28}{results[0]:>13.1f} us{results[1]:>13.1f} us{results[0] / results[1]:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
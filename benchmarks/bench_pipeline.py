@@ -0,0 +1,169 @@
+"""
+Benchmark of the message pipeline of FreeSmileyDealerCog, offline, with in-memory stand-ins for discord and mongodb.
+Reports throughput, latency percentiles and allocations per message for several message corpora.
+Run from the repository root: python benchmarks/bench_pipeline.py
+"""
+import asyncio
+import gc
+import random
+import sys
+import time
+import tracemalloc
+from typing import *
+
+import stand_ins
+from stand_ins import FakeAuthor, FakeChannel, FakeGuild, FakeMessage, InMemoryDatabase
+
+import discord
+
+from cogs.smileydealer import FreeSmileyDealerCog
+from database import Database
+from extensions import BasicBot
+from outbound import OutboundScheduler
+
+MESSAGES_COUNT = 5000
+ALLOCATIONS_MESSAGES_COUNT = 500
+GUILDS_COUNT = 500
+CHANNELS_PER_GUILD = 4
+WORDS = "hey what is up the quick brown fox jumps over lazy dog see you at 8 lol that was great".split()
+
+
+def make_guild_documents() -> List[Dict]:
+    """
+    Most guilds keep the defaults, the rest change the mode or limits, and some disable channels.
+    """
+    documents = []
+    for guild_id in range(1, GUILDS_COUNT + 1):
+        if random.random() < 0.6:
+            continue
+
+        settings = {"default": {"mode": random.randint(0, 2)}}
+        if random.random() < 0.3:
+            settings["default"]["max_smileys"] = random.randint(1, 10)
+        if random.random() < 0.2:
+            settings[str(guild_id * 100)] = {"enabled": False}
+        documents.append({"_id": str(guild_id), "settings": settings})
+    return documents
+
+
+def make_corpora(smiley_unicodes: Sequence[str], reaction_words: Sequence[str]) -> Dict[str, List[str]]:
+    def sentence(length: int) -> str:
+        return ' '.join(random.choices(WORDS, k=length))
+
+    return {
+        "plain text": [sentence(random.randint(3, 20)) for _ in range(MESSAGES_COUNT)],
+        "emoji heavy": [
+            ' '.join(random.choices(smiley_unicodes, k=random.randint(5, 30))) + ' ' + sentence(3)
+            for _ in range(MESSAGES_COUNT)],
+        "trigger words": [
+            f"{sentence(random.randint(2, 10))} {random.choice(reaction_words)} {sentence(3)}"
+            for _ in range(MESSAGES_COUNT)],
+        "long pastes": [
+            sentence(700) + ' ' + ' '.join(random.choices(smiley_unicodes, k=3))
+            for _ in range(MESSAGES_COUNT // 10)],
+    }
+
+
+def make_messages(contents: Iterable[str]) -> List[FakeMessage]:
+    guilds = [FakeGuild(guild_id) for guild_id in range(1, GUILDS_COUNT + 1)]
+    channels = {
+        guild.id: [FakeChannel(guild.id * 100 + i) for i in range(CHANNELS_PER_GUILD)]
+        for guild in guilds}
+
+    messages = []
+    for content in contents:
+        guild = random.choice(guilds)
+        messages.append(FakeMessage(
+            content, guild, random.choice(channels[guild.id]), FakeAuthor(random.randrange(1, 10_000))))
+    return messages
+
+
+async def make_cog(mongo_db: InMemoryDatabase, static_data: Dict) -> FreeSmileyDealerCog:
+    db = await Database.create(mongo_db)
+    bot = BasicBot(
+        discord.Intents.default(), db,
+        outbound=OutboundScheduler(max_depth=MESSAGES_COUNT, max_age=float("inf")))
+    # Mention prefixes need a logged in user
+    bot.command_prefix = db.config["prefix"]
+
+    cog = FreeSmileyDealerCog(bot, db)
+    await bot.add_cog(cog)
+    cog._set_smiley_emojis_dict(stand_ins.make_smiley_emojis_dict(static_data))
+    cog._smiley_emojis_dict_ready = True
+
+    # Like the bot does when it's ready
+    await db.warm_up_cache(range(1, GUILDS_COUNT + 1))
+    return cog
+
+
+async def drain_outbound(outbound: OutboundScheduler):
+    while outbound._workers:
+        await asyncio.sleep(0)
+
+
+async def measure_latencies(cog: FreeSmileyDealerCog, messages: Sequence[FakeMessage]) -> Tuple[List[float], float]:
+    """
+    :return: Latency of each message until its response is queued, and the seconds until all responses were sent.
+    """
+    latencies = []
+    t0 = time.perf_counter()
+    for message in messages:
+        message_t0 = time.perf_counter()
+        await cog.on_message(message)
+        latencies.append(time.perf_counter() - message_t0)
+
+    await drain_outbound(cog.bot.outbound)
+    return latencies, time.perf_counter() - t0
+
+
+async def measure_allocations(cog: FreeSmileyDealerCog, messages: Sequence[FakeMessage]) -> Tuple[float, float]:
+    """
+    :return: Mean peak of bytes allocated while answering a message, and mean count of memory blocks left behind.
+    """
+    gc.collect()
+    blocks_before = sys.getallocatedblocks()
+
+    tracemalloc.start()
+    peaks_sum = 0
+    for message in messages:
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        await cog.on_message(message)
+        await drain_outbound(cog.bot.outbound)
+        peaks_sum += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+
+    gc.collect()
+    return peaks_sum / len(messages), (sys.getallocatedblocks() - blocks_before) / len(messages)
+
+
+def percentile(sorted_values: Sequence[float], percent: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))]
+
+
+async def main():
+    random.seed(0)
+    static_data = stand_ins.load_static_data()
+    mongo_db = InMemoryDatabase(static_data, make_guild_documents())
+    cog = await make_cog(mongo_db, static_data)
+
+    corpora = make_corpora(
+        list(cog.smiley_index.smileys),
+        list(static_data["default_settings"]["random_reactions_chances"]))
+
+    print(f"{'corpus':<16}{'msgs/s':>10}{'p50':>11}{'p99':>11}{'peak alloc':>14}{'blocks':>9}{'queries':>9}")
+    for name, contents in corpora.items():
+        messages = make_messages(contents)
+        queries_count = mongo_db.queries_count
+
+        latencies, seconds = await measure_latencies(cog, messages)
+        allocated, blocks = await measure_allocations(cog, messages[:ALLOCATIONS_MESSAGES_COUNT])
+
+        latencies.sort()
+        print(f"{name:<16}{len(messages) / seconds:>10.0f}"
+              f"{percentile(latencies, 50) * 1e6:>8.1f} us{percentile(latencies, 99) * 1e6:>8.1f} us"
+              f"{allocated / 1024:>10.1f} KiB{blocks:>9.1f}{mongo_db.queries_count - queries_count:>9}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
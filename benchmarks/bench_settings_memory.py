@@ -0,0 +1,65 @@
+"""
+Memory benchmark of cached guild settings, raw mongodb documents against the compact settings.
+Run from the repository root: python benchmarks/bench_settings_memory.py
+"""
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "free_smiley_dealer"))
+
+from guild_settings import GuildSettings
+
+GUILDS_COUNT = 100_000
+
+
+def make_scope_settings(muted_users_count: int):
+    settings = {}
+    if random.random() < 0.5:
+        settings["mode"] = random.randint(0, 2)
+    if random.random() < 0.3:
+        settings["max_smileys"] = random.randint(1, 20)
+    if random.random() < 0.2:
+        settings["enabled"] = False
+    if muted_users_count:
+        settings["muted_users"] = [random.getrandbits(60) for _ in range(muted_users_count)]
+    return settings
+
+
+def make_documents():
+    """
+    Documents shaped like production ones: most guilds change one or two settings,
+    some configure a few channels, and a few mute many users.
+    """
+    random.seed(0)
+    documents = []
+    for _ in range(GUILDS_COUNT):
+        muted_users_count = random.choice((0,) * 8 + (2, 300 if random.random() < 0.05 else 5))
+        settings = {"default": make_scope_settings(muted_users_count)}
+        for _ in range(random.choice((0, 0, 0, 1, 3))):
+            settings[str(random.getrandbits(60))] = make_scope_settings(0)
+        documents.append({"_id": str(random.getrandbits(60)), "settings": settings})
+    return documents
+
+
+def measure(make):
+    tracemalloc.start()
+    result = make()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+
+def main():
+    random.seed(0)
+    documents, documents_size = measure(make_documents)
+    _, settings_size = measure(lambda: [GuildSettings.from_document(document) for document in documents])
+
+    print(f"{GUILDS_COUNT} guilds")
+    print(f"raw documents:   {documents_size / 2 ** 20:8.1f} MiB")
+    print(f"GuildSettings:   {settings_size / 2 ** 20:8.1f} MiB ({settings_size / documents_size:.0%})")
+
+
+if __name__ == "__main__":
+    main()
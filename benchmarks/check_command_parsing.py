@@ -0,0 +1,75 @@
+"""
+Check that the bot tells command messages apart like `commands.Bot.get_context` does, offline.
+Messages that aren't commands skip the command context, and go to the smiley pipeline instead.
+Run from the repository root: python benchmarks/check_command_parsing.py
+"""
+import asyncio
+import sys
+from typing import *
+
+import stand_ins
+from stand_ins import FakeAuthor, FakeChannel, FakeGuild, FakeMessage, InMemoryDatabase
+
+import discord
+
+from cogs.smileydealer import FreeSmileyDealerCog
+from database import Database
+from extensions import BasicBot
+
+BOT_USER_ID = 1000
+
+# Message content, and if it invokes a command with the prefix "s!"
+CASES: List[Tuple[str, bool]] = [
+    ("s!help", True),
+    ("s!h", True),
+    ("s!help me", True),
+    ("s!help\nme", True),
+    # The prefix alone invokes the command aliased ''
+    ("s!", True),
+    ("s! ", True),
+    ("s! x", True),
+    ("s! 😀", True),
+    ("s!nonexistent", False),
+    ("s!  help", True),
+    # Prefixes and commands are case sensitive
+    ("S!help", False),
+    ("s!HELP", False),
+    ("s !help", False),
+    ("help", False),
+    ("hey 😀", False),
+    ("", False),
+    (f"<@{BOT_USER_ID}> help", True),
+    (f"<@!{BOT_USER_ID}> help", True),
+    # The mention prefixes end with a space
+    (f"<@{BOT_USER_ID}>help", False),
+    (f"<@{BOT_USER_ID}> hey", False),
+]
+
+
+async def main() -> int:
+    static_data = stand_ins.load_static_data()
+    db = await Database.create(InMemoryDatabase(static_data))
+    bot = BasicBot(discord.Intents.default(), db)
+    bot._connection.user = FakeAuthor(BOT_USER_ID, bot=True)
+    await bot.add_cog(FreeSmileyDealerCog(bot, db, smiley_emojis_snapshot={}))
+
+    failed_count = 0
+    for content, expected in CASES:
+        message = FakeMessage(content, FakeGuild(1), FakeChannel(100), FakeAuthor(1))
+        message._state = bot._connection
+        is_command = await bot.is_command_message(message)
+        ctx = await bot.get_context(message)
+        invokes_command = ctx.command is not None
+
+        if is_command != expected or is_command != invokes_command:
+            failed_count += 1
+            print(f"FAIL {content!r}: is_command_message {is_command}, get_context {invokes_command}, "
+                  f"expected {expected}")
+        else:
+            print(f"ok   {content!r}: {is_command}")
+
+    return 1 if failed_count else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
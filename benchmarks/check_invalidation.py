@@ -0,0 +1,111 @@
+"""
+Check the cache invalidation feed against a local single node replica set, with the change stream and with polling.
+A second process is stood in for by a second database object: the guild and configuration changes it writes
+must evict the guild from the cache of the first, and reload its configurations.
+Start the replica set first:
+    mongod --replSet rs0 --dbpath <empty directory>
+    mongosh --eval "rs.initiate()"
+Run from the repository root: python benchmarks/check_invalidation.py [mongodb uri]
+"""
+import asyncio
+import sys
+import uuid
+from typing import *
+
+import stand_ins
+
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+
+import cogs.smileydealer  # Imported before the database, which imports its converters
+from database import Database
+from invalidation import InvalidationFeed
+
+# Defaults
+MONGODB_URI = "mongodb://localhost:27017/?directConnection=true"
+POLL_INTERVAL = 0.5
+# Seconds a change has to reach the caches of the first process
+TIMEOUT = 5
+# Seconds the feed has to start watching before changes are written
+START_DELAY = 1
+
+
+async def wait_for(predicate: Callable[[], Awaitable[bool]], timeout: float = TIMEOUT) -> bool:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not await predicate():
+        if asyncio.get_running_loop().time() >= deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+async def check_feed(name: str, mongo_db: AsyncIOMotorDatabase, watch: Callable[[InvalidationFeed], Awaitable],
+                     guild_id: int) -> int:
+    """
+    :param watch: Runs the feed of the first process
+    :param guild_id: A guild without a document
+    :return: Count of failed checks
+    """
+    db = await Database.create(mongo_db)
+    other_db = await Database.create(mongo_db)
+    mode = db.Setting("mode", guild_id=guild_id)
+    new_mode = await mode.read() + 1
+    new_prefix = f"{name.replace(' ', '_')}!"
+
+    async def is_guild_evicted() -> bool:
+        return await mode.read() == new_mode
+
+    async def are_configurations_reloaded() -> bool:
+        return db.config["prefix"] == new_prefix
+
+    watching = asyncio.create_task(watch(InvalidationFeed(db, poll_interval=POLL_INTERVAL)))
+    failed_count = 0
+    try:
+        await asyncio.sleep(START_DELAY)
+
+        # The guild is cached with its old mode, until the change of the other process evicts it
+        await other_db.Setting("mode", guild_id=guild_id).change(new_mode)
+        await other_db.flush_updates()
+        if await wait_for(is_guild_evicted):
+            print(f"ok   {name}: guild changed by another process was evicted")
+        else:
+            failed_count += 1
+            print(f"FAIL {name}: guild changed by another process is still cached, mode {await mode.read()}")
+
+        await mongo_db["configurations"].update_one({"_id": "config"}, {"$set": {"prefix": new_prefix}})
+        if await wait_for(are_configurations_reloaded):
+            print(f"ok   {name}: changed configurations were reloaded")
+        else:
+            failed_count += 1
+            print(f"FAIL {name}: changed configurations weren't reloaded, prefix {db.config['prefix']!r}")
+
+        if watching.done():
+            failed_count += 1
+            print(f"FAIL {name}: the feed stopped with {watching.exception()!r}")
+    finally:
+        watching.cancel()
+        await asyncio.gather(watching, return_exceptions=True)
+
+    return failed_count
+
+
+async def main() -> int:
+    mongodb_uri = sys.argv[1] if len(sys.argv) > 1 else MONGODB_URI
+    client = AsyncIOMotorClient(mongodb_uri, serverSelectionTimeoutMS=5000)
+    mongo_db = client[f"smiley_dealer_check_invalidation_{uuid.uuid4().hex[:8]}"]
+
+    await mongo_db["configurations"].insert_many([
+        {"_id": "static_data", **stand_ins.load_static_data()},
+        dict(stand_ins.CONFIG)])
+    try:
+        # The change stream is checked directly, the feed itself would fall back to polling without one
+        failed_count = await check_feed("change stream", mongo_db, InvalidationFeed.watch, 1)
+        failed_count += await check_feed("polling", mongo_db, InvalidationFeed.poll, 2)
+    finally:
+        await client.drop_database(mongo_db.name)
+        client.close()
+
+    return 1 if failed_count else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
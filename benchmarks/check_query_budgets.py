@@ -0,0 +1,97 @@
+"""
+Check the mongodb query budgets of the message pipeline and the settings commands, offline, with in-memory stand-ins.
+A message or command may query once for a guild missing from the cache, and not at all once it's cached.
+Run from the repository root: python benchmarks/check_query_budgets.py
+"""
+import asyncio
+import sys
+from typing import *
+
+import stand_ins
+from stand_ins import FakeAuthor, FakeChannel, FakeGuild, FakeMessage, InMemoryDatabase
+
+import discord
+
+import query_tracing
+from cogs.smileydealer import FreeSmileyDealerCog
+from database import Database
+from extensions import BasicBot
+from outbound import OutboundScheduler
+from query_tracing import QueryBudgetExceeded, TracedDatabase, assert_query_budget
+
+
+class FakeContext:
+    def __init__(self, message: FakeMessage, bot: BasicBot):
+        self.message = message
+        self.guild = message.guild
+        self.channel = message.channel
+        self.author = message.author
+        self.bot = bot
+
+    async def send(self, content: Optional[str] = None, *, embed: Optional[discord.Embed] = None):
+        await self.channel.send(content)
+
+
+async def make_cog(mongo_db: TracedDatabase, static_data: Dict) -> FreeSmileyDealerCog:
+    db = await Database.create(mongo_db)
+    bot = BasicBot(
+        discord.Intents.default(), db,
+        outbound=OutboundScheduler(max_age=float("inf")))
+    bot.command_prefix = db.config["prefix"]
+
+    cog = FreeSmileyDealerCog(bot, db)
+    await bot.add_cog(cog)
+    cog._set_smiley_emojis_dict(stand_ins.make_smiley_emojis_dict(static_data))
+    cog._smiley_emojis_dict_ready = True
+    return cog
+
+
+async def main() -> int:
+    static_data = stand_ins.load_static_data()
+    guilds = [{"_id": "1", "settings": {"default": {"mode": 1}}}]
+    cog = await make_cog(TracedDatabase(InMemoryDatabase(static_data, guilds)), static_data)
+    smiley = next(iter(cog.smiley_index.smileys))
+
+    def make_message(guild_id: int, content: str = f"hey {smiley}") -> FakeMessage:
+        return FakeMessage(content, FakeGuild(guild_id), FakeChannel(guild_id * 100), FakeAuthor(1))
+
+    async def max_smileys(message: FakeMessage):
+        await cog.command_max_smileys.callback(cog, FakeContext(message, cog.bot), 5, None)
+
+    async def settings(message: FakeMessage):
+        await cog.command_settings.callback(cog, FakeContext(message, cog.bot))
+
+    # Guild 1 is stored and the others are not, the first step on a guild caches it
+    budgets: List[Tuple[str, int, Callable[[FakeMessage], Awaitable], int]] = [
+        ("on_message, stored guild", 1, cog.on_message, 1),
+        ("on_message, cached guild", 0, cog.on_message, 1),
+        ("on_message, new guild", 1, cog.on_message, 2),
+        ("on_message, cached new guild", 0, cog.on_message, 2),
+        ("settings, new guild", 1, settings, 3),
+        ("maxsmileys, cached guild", 0, max_smileys, 3),
+        ("settings, after maxsmileys", 0, settings, 3),
+        ("on_message, after maxsmileys", 0, cog.on_message, 3),
+        ("maxsmileys, new guild", 1, max_smileys, 4),
+    ]
+
+    failed_count = 0
+    for name, max_queries, handle, guild_id in budgets:
+        try:
+            with assert_query_budget(max_queries, name) as scope:
+                await handle(make_message(guild_id))
+        except QueryBudgetExceeded as e:
+            failed_count += 1
+            print(f"FAIL {e}")
+        else:
+            print(f"ok   {name}: {scope.queries_count}/{max_queries} queries")
+
+    print(f"\n{'path':<32}{'traced':>8}{'per trace':>11}  queries")
+    for path, stats in query_tracing.query_stats().items():
+        per_trace = "" if stats["queries_per_trace"] is None else f"{stats['queries_per_trace']:.2f}"
+        print(f"{path:<32}{stats['traced']:>8}{per_trace:>11}  {stats['queries']}")
+
+    return 1 if failed_count else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
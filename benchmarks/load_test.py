@@ -0,0 +1,469 @@
+"""
+End-to-end load test of the bot against a local stand-in for the discord REST API and gateway.
+The stand-in replays MESSAGE_CREATE events across many guilds, and rate limits the REST API like discord does,
+with X-RateLimit-* headers and 429s. For each mode it measures the latency from an event until the first request
+answering it, the requests per answered message, rate limit stalls and the responses dropped by the bot or failed after retrying.
+Run from the repository root: python benchmarks/load_test.py [--rate 1000] [--duration 10] [--guilds 1000]
+"""
+import argparse
+import asyncio
+import copy
+import datetime
+import json
+import logging
+import random
+import re
+import threading
+import time
+from typing import *
+
+import stand_ins
+from stand_ins import InMemoryDatabase
+
+import discord
+from aiohttp import web
+
+from cogs.smileydealer import FreeSmileyDealerCog
+from cogs.smileydealer.core import SCANNED_EMOJI_UNICODE_TO_NAME, Mode
+from database import Database
+from extensions import BasicBot
+
+HOST = "127.0.0.1"
+DISCORD_EPOCH = 1420070400000
+BOT_USER_ID = 1
+APPLICATION_ID = 2
+EMOJI_GUILD_ID = 3
+FIRST_GUILD_ID = 10
+CHANNELS_PER_GUILD = 2
+REPLAY_TICK = 0.01
+DRAIN_SECONDS = 5
+WORDS = "hey what is up the quick brown fox jumps over lazy dog see you at 8 lol that was great".split()
+
+# Rate limits like discord's: (requests, per seconds)
+GLOBAL_LIMIT = (50, 1)
+SEND_MESSAGE_LIMIT = (5, 5)
+ADD_REACTION_LIMIT = (1, 0.25)
+# A request this soon after its bucket reset waited for the reset
+STALL_TOLERANCE = 0.05
+
+REGEX_CUSTOM_EMOJI = re.compile(r"<a?:\w+:(\d+)>")
+
+
+def make_snowflake(sequence: int) -> int:
+    return (int(time.time() * 1000) - DISCORD_EPOCH) << 22 | sequence % (1 << 22)
+
+
+def make_user(user_id: int, *, bot: bool = False) -> Dict:
+    return {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0001", "avatar": None, "bot": bot}
+
+
+def make_message(message_id: int, channel_id: int, guild_id: Optional[int], author: Dict, content: str) -> Dict:
+    message = {
+        "id": str(message_id), "channel_id": str(channel_id), "author": author, "content": content,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(), "edited_timestamp": None,
+        "tts": False, "mention_everyone": False, "mentions": [], "mention_roles": [], "attachments": [],
+        "embeds": [], "pinned": False, "type": 0, "flags": 0}
+    if guild_id is not None:
+        message["guild_id"] = str(guild_id)
+    return message
+
+
+def json_response(data: Dict, *, status: int = 200, headers: Optional[Dict[str, str]] = None) -> web.Response:
+    # discord.py only parses bodies of exactly this content type
+    return web.Response(
+        body=json.dumps(data).encode(), status=status, headers={**(headers or {}), "Content-Type": "application/json"})
+
+
+class RateLimit:
+    """
+    Fixed window rate limit per key, which also keeps count of the stalls of its keys.
+    """
+
+    def __init__(self, limit: int, per: float, bucket_hash: str):
+        self.limit = limit
+        self.per = per
+        self.bucket_hash = bucket_hash
+        # Key: [Window start, Requests in window, Exhausted at]
+        self._windows: Dict[Hashable, list] = {}
+
+        self.stalls_count = 0
+        self.stalls_seconds = 0.0
+
+    def hit(self, key: Hashable, now: float) -> Tuple[bool, int, float]:
+        """
+        :return: Whether the request is allowed, the remaining requests, and seconds until the window resets.
+        """
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.per:
+            if window is not None and window[2] is not None:
+                reset_at = window[0] + self.per
+                if now - reset_at <= STALL_TOLERANCE:
+                    self.stalls_count += 1
+                    self.stalls_seconds += reset_at - window[2]
+            window = self._windows[key] = [now, 0, None]
+
+        reset_after = self.per - (now - window[0])
+        if window[1] >= self.limit:
+            return False, 0, reset_after
+
+        window[1] += 1
+        if window[1] == self.limit:
+            window[2] = now
+        return True, self.limit - window[1], reset_after
+
+    def headers(self, remaining: int, reset_after: float) -> Dict[str, str]:
+        return {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(remaining),
+            "X-RateLimit-Reset": f"{time.time() + reset_after:.3f}",
+            "X-RateLimit-Reset-After": f"{reset_after:.3f}",
+            "X-RateLimit-Bucket": self.bucket_hash,
+        }
+
+
+class ReplayedMessage:
+    __slots__ = ("emitted_at", "mode", "answered_at", "requests_count")
+
+    def __init__(self, emitted_at: float, mode: str):
+        self.emitted_at = emitted_at
+        self.mode = mode
+        self.answered_at = None
+        self.requests_count = 0
+
+
+class FakeDiscord:
+    """
+    Stand-in for the discord REST API and gateway of a single shard, run in its own thread and event loop.
+    Every replayed message starts with a smiley no other message of its channel in flight starts with,
+    so the responses, which start with the emoji of that smiley, can be told apart.
+    """
+
+    def __init__(self, static_data: Dict, guilds_count: int, rate: float):
+        self.guilds_count = guilds_count
+        self.rate = rate
+        self.port = None
+        self.mode = None
+
+        # (Smiley id, unicode) of the smileys that have a unicode emoji
+        unicode_by_name = {name: unicode for unicode, name in SCANNED_EMOJI_UNICODE_TO_NAME.items()}
+        self.keyed_smileys = [
+            (smiley_id, next(unicode_by_name[name] for name in smiley_names if name in unicode_by_name))
+            for smiley_id, smiley_names in enumerate(static_data["smileys"])
+            if any(name in unicode_by_name for name in smiley_names)]
+        self.smiley_names = [smiley_names[0] for smiley_names in static_data["smileys"]]
+
+        self.guild_ids = list(range(FIRST_GUILD_ID, FIRST_GUILD_ID + guilds_count))
+        self._sequence = 0
+        self._channel_counters: Dict[int, int] = {}
+        self._in_flight: Dict[Tuple[int, int], int] = {}
+        self.messages: Dict[int, ReplayedMessage] = {}
+
+        self.global_limit = RateLimit(*GLOBAL_LIMIT, "global")
+        self.send_message_limit = RateLimit(*SEND_MESSAGE_LIMIT, "send_message")
+        self.add_reaction_limit = RateLimit(*ADD_REACTION_LIMIT, "add_reaction")
+        self.requests_count = 0
+        self.rate_limited_count = 0
+        self.globally_rate_limited_count = 0
+
+        self._ready = threading.Event()
+        self._loop = None
+
+    # Lifecycle
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        self._ready.wait()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(self._serve())
+        self._ready.set()
+        self._loop.run_forever()
+
+    async def _serve(self):
+        app = web.Application()
+        app.router.add_get("/gateway", self.handle_gateway)
+        app.router.add_get("/api/v10/users/@me", self.handle_get_bot_user)
+        app.router.add_get("/api/v10/oauth2/applications/@me", self.handle_get_application)
+        app.router.add_get("/api/v10/gateway/bot", self.handle_get_gateway_bot)
+        app.router.add_post("/api/v10/channels/{channel_id}/messages", self.handle_send_message)
+        app.router.add_put(
+            "/api/v10/channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me", self.handle_add_reaction)
+
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, HOST, 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    @property
+    def api_url(self) -> str:
+        return f"http://{HOST}:{self.port}/api/v10"
+
+    # REST API
+
+    async def handle_get_bot_user(self, request: web.Request) -> web.Response:
+        return json_response(make_user(BOT_USER_ID, bot=True))
+
+    async def handle_get_application(self, request: web.Request) -> web.Response:
+        return json_response({
+            "id": str(APPLICATION_ID), "name": "Free Smiley Dealer", "description": "", "icon": None,
+            "bot_public": True, "bot_require_code_grant": False, "owner": make_user(BOT_USER_ID + 100),
+            "verify_key": "", "flags": 0})
+
+    async def handle_get_gateway_bot(self, request: web.Request) -> web.Response:
+        return json_response({
+            "url": f"ws://{HOST}:{self.port}/gateway", "shards": 1,
+            "session_start_limit": {"total": 1000, "remaining": 1000, "reset_after": 0, "max_concurrency": 1}})
+
+    def _rate_limit(self, rate_limit: RateLimit, key: Hashable) -> Optional[web.Response]:
+        """
+        :return: A 429 response if rate limited.
+        """
+        self.requests_count += 1
+        now = time.perf_counter()
+
+        allowed, _, reset_after = self.global_limit.hit(None, now)
+        if not allowed:
+            self.rate_limited_count += 1
+            self.globally_rate_limited_count += 1
+            return json_response(
+                {"message": "You are being rate limited.", "retry_after": reset_after, "global": True},
+                status=429, headers={"Via": "1.1 google", "X-RateLimit-Global": "true", "X-RateLimit-Scope": "global"})
+
+        allowed, remaining, reset_after = rate_limit.hit(key, now)
+        headers = {"Via": "1.1 google", **rate_limit.headers(remaining, reset_after)}
+        if not allowed:
+            self.rate_limited_count += 1
+            return json_response(
+                {"message": "You are being rate limited.", "retry_after": reset_after, "global": False},
+                status=429, headers={**headers, "X-RateLimit-Scope": "user"})
+
+        return web.Response(status=200, headers=headers)
+
+    def _count_response(self, message_id: Optional[int], answered: bool):
+        message = self.messages.get(message_id)
+        if message is None:
+            return
+
+        message.requests_count += 1
+        if answered and message.answered_at is None:
+            message.answered_at = time.perf_counter()
+
+    async def handle_send_message(self, request: web.Request) -> web.Response:
+        channel_id = int(request.match_info["channel_id"])
+        content = (await request.json())["content"]
+
+        # The message answered, by the smiley of the first emoji
+        match = REGEX_CUSTOM_EMOJI.search(content)
+        message_id = match and self._in_flight.get((channel_id, int(match.group(1)) // 1000 - 1))
+
+        response = self._rate_limit(self.send_message_limit, channel_id)
+        self._count_response(message_id, response.status == 200)
+        if response.status != 200:
+            return response
+
+        data = make_message(
+            make_snowflake(self._next_sequence()), channel_id, None, make_user(BOT_USER_ID, bot=True), content)
+        return json_response(data, headers=response.headers)
+
+    async def handle_add_reaction(self, request: web.Request) -> web.Response:
+        response = self._rate_limit(self.add_reaction_limit, int(request.match_info["channel_id"]))
+        self._count_response(int(request.match_info["message_id"]), response.status == 200)
+        if response.status != 200:
+            return response
+
+        return web.Response(status=204, headers=response.headers)
+
+    # Gateway
+
+    def _next_sequence(self) -> int:
+        self._sequence += 1
+        return self._sequence
+
+    async def handle_gateway(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json({"op": 10, "d": {"heartbeat_interval": 41250}})
+
+        replaying = None
+        try:
+            async for msg in ws:
+                payload = json.loads(msg.data)
+                if payload["op"] == 1:
+                    await ws.send_json({"op": 11})
+                elif payload["op"] == 2:
+                    await self._send_ready(ws)
+                    replaying = asyncio.create_task(self._replay_messages(ws))
+        finally:
+            if replaying:
+                replaying.cancel()
+        return ws
+
+    async def _dispatch(self, ws: web.WebSocketResponse, event: str, data: Dict):
+        await ws.send_json({"op": 0, "s": self._next_sequence(), "t": event, "d": data})
+
+    async def _send_ready(self, ws: web.WebSocketResponse):
+        await self._dispatch(ws, "READY", {
+            "v": 10, "user": make_user(BOT_USER_ID, bot=True), "session_id": "load-test",
+            "resume_gateway_url": f"ws://{HOST}:{self.port}/gateway", "shard": [0, 1],
+            "application": {"id": str(APPLICATION_ID), "flags": 0},
+            "guilds": [{"id": str(guild_id), "unavailable": True} for guild_id in [EMOJI_GUILD_ID, *self.guild_ids]]})
+
+        emojis = [
+            {"id": str(1000 * (smiley_id + 1) + i), "name": f"{smiley_name}_{i}", "animated": False, "available": True,
+             "require_colons": True, "managed": False, "roles": []}
+            for smiley_id, smiley_name in enumerate(self.smiley_names) for i in range(2)]
+        await self._dispatch(ws, "GUILD_CREATE", self._make_guild(EMOJI_GUILD_ID, emojis))
+        for guild_id in self.guild_ids:
+            await self._dispatch(ws, "GUILD_CREATE", self._make_guild(guild_id))
+
+    @staticmethod
+    def _make_guild(guild_id: int, emojis: Sequence[Dict] = ()) -> Dict:
+        return {
+            "id": str(guild_id), "name": f"guild{guild_id}", "unavailable": False, "member_count": 100,
+            "large": False, "owner_id": str(BOT_USER_ID + 100), "features": [], "emojis": list(emojis),
+            "stickers": [], "members": [], "presences": [], "voice_states": [], "threads": [],
+            "stage_instances": [], "guild_scheduled_events": [], "soundboard_sounds": [],
+            "joined_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "roles": [{"id": str(guild_id), "name": "@everyone", "permissions": "968552803905", "position": 0,
+                       "color": 0, "hoist": False, "managed": False, "mentionable": False, "flags": 0}],
+            "channels": [
+                {"id": str(guild_id * 100 + i), "type": 0, "name": f"channel{i}", "position": i,
+                 "permission_overwrites": []}
+                for i in range(CHANNELS_PER_GUILD)]}
+
+    def _make_message_create(self) -> Dict:
+        guild_id = random.choice(self.guild_ids)
+        channel_id = guild_id * 100 + random.randrange(CHANNELS_PER_GUILD)
+
+        counter = self._channel_counters.get(channel_id, 0)
+        self._channel_counters[channel_id] = counter + 1
+        smiley_id, smiley_unicode = self.keyed_smileys[counter % len(self.keyed_smileys)]
+        extra_smileys = [unicode for _, unicode in random.sample(self.keyed_smileys, random.randint(0, 2))]
+        content = ' '.join([smiley_unicode, *random.choices(WORDS, k=random.randint(1, 8)), *extra_smileys])
+
+        message_id = make_snowflake(self._next_sequence())
+        self._in_flight[(channel_id, smiley_id)] = message_id
+        self.messages[message_id] = ReplayedMessage(time.perf_counter(), self.mode)
+        return make_message(
+            message_id, channel_id, guild_id, make_user(random.randrange(1000, 1_000_000)), content)
+
+    async def _replay_messages(self, ws: web.WebSocketResponse):
+        carry = 0.0
+        while True:
+            await asyncio.sleep(REPLAY_TICK)
+            if self.mode is None:
+                continue
+
+            carry += self.rate * REPLAY_TICK
+            for _ in range(int(carry)):
+                await self._dispatch(ws, "MESSAGE_CREATE", self._make_message_create())
+            carry -= int(carry)
+
+
+def percentile(sorted_values: Sequence[float], percent: float) -> float:
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))]
+
+
+class CountingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record: logging.LogRecord):
+        self.count += 1
+
+
+def get_counters(fake_discord: FakeDiscord, bot: BasicBot, failed_sends: CountingHandler) -> Dict[str, float]:
+    limits = (fake_discord.send_message_limit, fake_discord.add_reaction_limit)
+    outbound_stats = bot.outbound.stats()
+    return {
+        "rate_limited": fake_discord.rate_limited_count,
+        "globally_rate_limited": fake_discord.globally_rate_limited_count,
+        "stalls": sum(limit.stalls_count for limit in limits),
+        "stalled_seconds": sum(limit.stalls_seconds for limit in limits),
+        "dropped": outbound_stats["dropped_stale"] + outbound_stats["dropped_overflow"],
+        "failed": failed_sends.count,
+    }
+
+
+def set_default_mode(db: Database, mongo_db: InMemoryDatabase, static_data: Dict, mode: Mode):
+    static_data = copy.deepcopy(static_data)
+    static_data["default_settings"]["mode"] = int(mode)
+    # Stored too, or polling for configuration changes would revert it
+    mongo_db["configurations"].documents["static_data"] = static_data
+    db.apply_configurations(static_data, db.config)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=1000, help="MESSAGE_CREATE events per second")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of replay per mode")
+    parser.add_argument("--guilds", type=int, default=1000, help="Count of guilds messages are spread across")
+    args = parser.parse_args()
+
+    # Failed sends are counted instead of logged, rate limit warnings are expected
+    failed_sends = CountingHandler()
+    logging.getLogger("outbound").addHandler(failed_sends)
+    logging.getLogger("outbound").propagate = False
+    logging.getLogger("discord").setLevel(logging.ERROR)
+
+    random.seed(0)
+    static_data = stand_ins.load_static_data()
+    fake_discord = FakeDiscord(static_data, args.guilds, args.rate)
+    fake_discord.start()
+    discord.http.Route.BASE = fake_discord.api_url
+
+    config = {**stand_ins.CONFIG, "emoji_guilds_id": [str(EMOJI_GUILD_ID)]}
+    mongo_db = InMemoryDatabase(static_data, config=config)
+    db = await Database.create(mongo_db)
+
+    intents = discord.Intents.default()
+    intents.message_content = True
+    bot = BasicBot(intents, db)
+    cog = FreeSmileyDealerCog(bot, db)
+    await bot.add_cog(cog)
+
+    await bot.login("load-test-token")
+    bot_task = asyncio.create_task(bot.connect())
+    await bot.wait_until_ready()
+    while not cog._smiley_emojis_dict_ready:
+        await asyncio.sleep(0.1)
+
+    print(f"{args.rate:.0f} messages/s for {args.duration:.0f}s per mode, across {args.guilds} guilds")
+    print(f"{'mode':<10}{'messages':>10}{'answered':>10}{'p50':>10}{'p99':>10}{'max':>10}{'reqs/resp':>11}"
+          f"{'429s':>7}{'global':>8}{'stalls':>8}{'stalled':>10}{'dropped':>9}{'failed':>8}")
+    for mode in (Mode.simple, Mode.title, Mode.reaction):
+        set_default_mode(db, mongo_db, static_data, mode)
+        counters_before = get_counters(fake_discord, bot, failed_sends)
+
+        fake_discord.mode = mode.name
+        await asyncio.sleep(args.duration)
+        fake_discord.mode = None
+        await asyncio.sleep(DRAIN_SECONDS)
+
+        counters_after = get_counters(fake_discord, bot, failed_sends)
+        counters = {name: counters_after[name] - counters_before[name] for name in counters_after}
+
+        messages = [message for message in fake_discord.messages.values() if message.mode == mode.name]
+        answered = [message for message in messages if message.answered_at is not None]
+        latencies = sorted(message.answered_at - message.emitted_at for message in answered)
+        requests_per_response = sum(message.requests_count for message in answered) / max(len(answered), 1)
+
+        print(f"{mode.name:<10}{len(messages):>10}{len(answered):>10}"
+              f"{percentile(latencies, 50) * 1000:>8.0f}ms{percentile(latencies, 99) * 1000:>8.0f}ms"
+              f"{percentile(latencies, 100) * 1000:>8.0f}ms{requests_per_response:>11.2f}"
+              f"{counters['rate_limited']:>7}{counters['globally_rate_limited']:>8}"
+              f"{counters['stalls']:>8}{counters['stalled_seconds']:>9.1f}s"
+              f"{counters['dropped']:>9}{counters['failed']:>8}")
+
+    print(f"{fake_discord.requests_count} requests, {fake_discord.rate_limited_count} rate limited")
+    await bot.close()
+    await bot_task
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
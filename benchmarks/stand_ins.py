@@ -0,0 +1,154 @@
+"""
+In-memory stand-ins for mongodb and the discord objects the message pipeline touches, for the benchmarks.
+"""
+import datetime
+import itertools
+import json
+import os
+import sys
+from typing import *
+
+from pymongo.errors import OperationFailure
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATIC_DATA_FIXTURE_FILENAME = os.path.join(REPOSITORY_DIRECTORY, "benchmarks", "fixtures", "static_data.json")
+
+sys.path.insert(0, os.path.join(REPOSITORY_DIRECTORY, "free_smiley_dealer"))
+# The bot loads its data files relative to the working directory
+os.chdir(REPOSITORY_DIRECTORY)
+
+CONFIG = {
+    "_id": "config",
+    "prefix": "s!",
+    "emoji_guilds_id": [],
+    "admin_users_id": [],
+}
+
+
+def load_static_data() -> Dict:
+    with open(STATIC_DATA_FIXTURE_FILENAME, 'r') as f:
+        return json.load(f)
+
+
+class InMemoryCursor:
+    def __init__(self, documents: List[Dict]):
+        self._documents = documents
+
+    def sort(self, key: str, direction: int) -> "InMemoryCursor":
+        self._documents.sort(key=lambda doc: doc[key], reverse=direction < 0)
+        return self
+
+    def limit(self, count: int) -> "InMemoryCursor":
+        self._documents = self._documents[:count]
+        return self
+
+    async def to_list(self, length: Optional[int]) -> List[Dict]:
+        return self._documents[:length]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self._documents:
+            yield document
+
+
+class InMemoryCollection:
+    """
+    The part of a motor collection the bot uses, queries by `_id` only.
+    """
+
+    def __init__(self, documents: Iterable[Dict] = ()):
+        self.documents = {doc["_id"]: doc for doc in documents}
+        self.queries_count = 0
+
+    async def find_one(self, query: Dict, projection: Optional[Dict] = None) -> Optional[Dict]:
+        self.queries_count += 1
+        return self.documents.get(query["_id"])
+
+    def find(self, query: Dict, projection: Optional[Dict] = None) -> InMemoryCursor:
+        self.queries_count += 1
+        ids = query.get("_id", {}).get("$in")
+        if ids is None:
+            return InMemoryCursor([])
+
+        return InMemoryCursor([self.documents[doc_id] for doc_id in ids if doc_id in self.documents])
+
+    async def create_index(self, keys: str) -> str:
+        return f"{keys}_1"
+
+    async def bulk_write(self, requests: Sequence, ordered: bool = True):
+        self.queries_count += 1
+        for request in requests:
+            document = request._filter["_id"]
+            self.documents.setdefault(document, {"_id": document})
+
+
+class InMemoryDatabase(dict):
+    def __init__(self, static_data: Dict, guilds: Iterable[Dict] = (), config: Dict = CONFIG):
+        super().__init__(
+            configurations=InMemoryCollection([static_data, config]),
+            guilds=InMemoryCollection(guilds))
+
+    def watch(self, pipeline: List[Dict]):
+        # Like a standalone server, changes are polled instead
+        raise OperationFailure("The $changeStream stage is only supported on replica sets", code=40573)
+
+    @property
+    def queries_count(self) -> int:
+        return sum(collection.queries_count for collection in self.values())
+
+
+class FakeEmoji:
+    def __init__(self, name: str, emoji_id: int):
+        self.name = name
+        self.id = emoji_id
+
+    def __str__(self):
+        return f"<:{self.name}:{self.id}>"
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+        self.sent_count = 0
+
+    async def send(self, content: str):
+        self.sent_count += 1
+
+
+class FakeAuthor:
+    def __init__(self, user_id: int, bot: bool = False):
+        self.id = user_id
+        self.bot = bot
+        self.mention = f"<@{user_id}>"
+
+
+class FakeMessage:
+    _ids = itertools.count(1)
+
+    def __init__(self, content: str, guild: FakeGuild, channel: FakeChannel, author: FakeAuthor):
+        self.id = next(FakeMessage._ids)
+        self.content = content
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        self.reactions_count = 0
+
+    async def add_reaction(self, emoji):
+        self.reactions_count += 1
+
+
+def make_smiley_emojis_dict(static_data: Dict) -> Dict[str, List[FakeEmoji]]:
+    """
+    A registry with a couple of emojis for every smiley, like the emoji guilds have.
+    """
+    return {
+        smiley_names[0]: [FakeEmoji(f"{smiley_names[0]}_{i}", 1000 * smiley_id + i) for i in range(2)]
+        for smiley_id, smiley_names in enumerate(static_data["smileys"])}
@@ -0,0 +1,87 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+# Returned for missing keys, since None is a valid cached value
+MISSING = object()
+
+
+class LRUCache:
+    """
+    Least recently used cache, with an optional time to live for entries.
+    None values are cached like any other value, so negative results can be cached too.
+    """
+
+    def __init__(self, capacity: int, ttl: Optional[float] = None):
+        """
+        :param capacity: Maximum count of entries, the least recently used entry is evicted first.
+        :param ttl: Seconds an entry stays valid after it was set.
+                    None - If entries never expire
+        """
+        if capacity < 1:
+            raise ValueError("Cache capacity must be positive.")
+
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, Tuple[float, Any]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, count=False) is not MISSING
+
+    def get(self, key: Hashable, default: Any = MISSING, *, count: bool = True) -> Any:
+        """
+        Get a value and mark it as the most recently used.
+        :param count: Whether to count the lookup as a hit or a miss.
+        :return: The value, or `default` if the key is missing or expired.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at >= time.monotonic():
+                self._entries.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return value
+
+            del self._entries[key]
+            self.expirations += 1
+
+        if count:
+            self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,160 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import time
+from typing import *
+
+import discord
+
+# Defaults
+RESTART_DELAY = 5
+MAX_RESTART_DELAY = 300
+# Seconds a worker has to run for its restart delay to be reset
+STABLE_UPTIME = 600
+# Seconds a stopped worker has to close its bot before it's killed
+STOP_TIMEOUT = 30
+
+logger = logging.getLogger(__name__)
+
+
+def split_shards(shard_count: int, workers_count: int) -> List[List[int]]:
+    """
+    Split the shard ids into consecutive ranges of about the same size, one per worker.
+    """
+    workers_count = min(workers_count, shard_count)
+    return [
+        list(range(shard_count * i // workers_count, shard_count * (i + 1) // workers_count))
+        for i in range(workers_count)]
+
+
+async def fetch_recommended_shard_count(token: str) -> int:
+    client = discord.Client(intents=discord.Intents.none())
+    try:
+        await client.login(token)
+        shard_count, _, _ = await client.http.get_bot_gateway()
+        return shard_count
+    finally:
+        await client.close()
+
+
+class ClusterWorker:
+    """
+    The part of the cluster a worker process runs, passed to the worker when it's started.
+    Workers share the counts of their guilds, so each can tell the total.
+    """
+
+    def __init__(self, index: int, shard_ids: List[int], shard_count: int, guilds_counts: Sequence[int]):
+        """
+        :param index: Index of the worker in the cluster
+        :param shard_ids: The shards the worker runs
+        :param shard_count: Count of shards in the whole cluster
+        :param guilds_counts: Shared array of the guilds count of every worker
+        """
+        self.index = index
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self._guilds_counts = guilds_counts
+
+    def set_guilds_count(self, guilds_count: int):
+        self._guilds_counts[self.index] = guilds_count
+
+    def get_total_guilds_count(self) -> int:
+        return sum(self._guilds_counts)
+
+
+class ClusterSupervisor:
+    """
+    Runs the shards split across worker processes, and restarts workers that exit.
+    Workers that keep crashing are restarted with a growing delay.
+    """
+
+    def __init__(self, target: Callable[[ClusterWorker], Any], shard_count: int, workers_count: int, *,
+                 restart_delay: float = RESTART_DELAY, max_restart_delay: float = MAX_RESTART_DELAY):
+        """
+        :param target: Runs a worker in its process, must be picklable
+        :param shard_count: Count of shards to run
+        :param workers_count: Count of worker processes, at most one per shard
+        """
+        self.target = target
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+
+        # Spawned workers don't inherit the event loop and connections of this process
+        self._context = multiprocessing.get_context("spawn")
+        shards_by_worker = split_shards(shard_count, workers_count)
+        guilds_counts = self._context.Array('i', len(shards_by_worker), lock=False)
+        self.workers = [
+            ClusterWorker(index, shard_ids, shard_count, guilds_counts)
+            for index, shard_ids in enumerate(shards_by_worker)]
+
+        self._processes: Dict[int, multiprocessing.Process] = {}
+        self._started_at: Dict[int, float] = {}
+        self._restart_delays: Dict[int, float] = {}
+        self._restart_at: Dict[int, float] = {}
+        self._stopping = False
+
+    def _start_worker(self, worker: ClusterWorker):
+        process = self._context.Process(
+            target=self.target, args=(worker,), name=f"cluster-worker-{worker.index}", daemon=True)
+        process.start()
+        self._processes[worker.index] = process
+        self._started_at[worker.index] = time.monotonic()
+        logger.info(f"Started worker {worker.index} with shards "
+                    f"{worker.shard_ids[0]}-{worker.shard_ids[-1]} of {worker.shard_count}.")
+
+    def _schedule_restart(self, worker: ClusterWorker):
+        process = self._processes.pop(worker.index)
+        uptime = time.monotonic() - self._started_at[worker.index]
+
+        delay = self._restart_delays.get(worker.index, self.restart_delay)
+        if uptime >= STABLE_UPTIME:
+            delay = self.restart_delay
+        self._restart_delays[worker.index] = min(delay * 2, self.max_restart_delay)
+        self._restart_at[worker.index] = time.monotonic() + delay
+
+        logger.error(f"Worker {worker.index} exited with code {process.exitcode} after {uptime:.0f}s, "
+                     f"restarting in {delay:.0f}s.")
+
+    def run(self):
+        """
+        Start the workers and supervise them until interrupted.
+        """
+        for worker in self.workers:
+            self._start_worker(worker)
+
+        try:
+            while not self._stopping:
+                timeout = None
+                if self._restart_at:
+                    timeout = max(0., min(self._restart_at.values()) - time.monotonic())
+                multiprocessing.connection.wait([p.sentinel for p in self._processes.values()], timeout)
+
+                for worker in self.workers:
+                    process = self._processes.get(worker.index)
+                    if process is not None and not process.is_alive():
+                        self._schedule_restart(worker)
+                    elif worker.index in self._restart_at and time.monotonic() >= self._restart_at[worker.index]:
+                        del self._restart_at[worker.index]
+                        self._start_worker(worker)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+        Stop the workers, they close their bots on SIGTERM.
+        """
+        self._stopping = True
+        for process in self._processes.values():
+            process.terminate()
+
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for process in self._processes.values():
+            process.join(max(0., deadline - time.monotonic()))
+            if process.is_alive():
+                logger.error(f"Worker {process.name} didn't stop in time, killing it.")
+                process.kill()
+                process.join()
+        self._processes.clear()
+        logger.info("Stopped all workers.")
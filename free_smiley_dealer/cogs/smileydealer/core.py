@@ -1,42 +1,62 @@
 from __future__ import annotations
 
 import asyncio
-import copy
 import enum
 import json
 import logging
+import os
 import random
 import re
 from contextlib import suppress
 from typing import (
-    Type, Iterable, Optional, Dict, Iterator, Sequence, AsyncIterator, Union, Tuple, Any)
+    Type, Iterable, List, Optional, Dict, Sequence, Set, Union, Tuple, Any)
 
 import discord
 import emojis
 import emojis.db
-from aioitertools import islice, list as aiolist
 from discord import Guild, Emoji
 from discord.ext import commands
 from emojis.emojis import EMOJI_TO_ALIAS
 
 import extensions
+import metrics
+from query_tracing import trace_queries
 from utils import chance, iter_unique_values, user_full_name
-from database import Database, is_enabled, author_not_muted
+from database import Database
+from guild_settings import ScopeSettings
 from .converters import (
     SettingsDefaultConverter, SettingsChannelConverter,
     create_enum_converter, Default, SettingsAllConverter, All)
+from .matching import SmileyIndex, WordMatcher
 
 # Constants
 DISCORD_EMOJI_CODES_FILENAME = "discord_emoji_codes.json"
-REGEX_FIND_WORD_IN_MESSAGE = re.compile(r'\b{}\b', re.IGNORECASE)
+SMILEY_EMOJIS_SNAPSHOT_FILENAME = "smiley_emojis_snapshot.json"
+# Seconds between refetches of the emoji guilds on the shards of other cluster workers
+REMOTE_EMOJI_GUILDS_REFRESH_INTERVAL = 600
 
 # Load data
 with open(DISCORD_EMOJI_CODES_FILENAME, 'r') as f:
     DISCORD_CODE_TO_EMOJI = json.load(f)
     DISCORD_EMOJI_TO_CODE = {v: k for k, v in DISCORD_CODE_TO_EMOJI.items()}
 
+# Emoji names by unicode, discord names take precedence
+EMOJI_UNICODE_TO_NAME = {
+    emoji_unicode: emoji_name.replace(':', '').replace('-', '_')
+    for emoji_unicode, emoji_name in {**EMOJI_TO_ALIAS, **DISCORD_EMOJI_TO_CODE}.items()}
+# The emojis found in messages, those of `emojis.iter`. The discord codes also name the text presentation
+# forms of some emojis ("❤" without the emoji variation selector), which are plain text in messages
+SCANNED_EMOJI_UNICODE_TO_NAME = {
+    emoji_unicode: EMOJI_UNICODE_TO_NAME[emoji_unicode] for emoji_unicode in EMOJI_TO_ALIAS}
+
 logger = logging.getLogger(__name__)
 
+# Metrics
+STAGE_SECONDS = metrics.Histogram(
+    "smiley_dealer_stage_seconds", "Seconds spent in each stage of answering messages.", ("stage",))
+RESPONSES = metrics.Counter(
+    "smiley_dealer_responses_total", "Smiley responses sent, by mode. Merged responses count once.", ("mode",))
+
 
 def format_error(msg) -> str:
     """Command error format for user."""
@@ -174,51 +194,269 @@ def split_smiley_emoji_name_into_parts(smiley_emoji_name: str) -> Optional[
 
 
 class FreeSmileyDealerCog(commands.Cog):
-    def __init__(self, bot: extensions.BasicBot, db: Database):
+    def __init__(self, bot: extensions.BasicBot, db: Database, *,
+                 smiley_emojis_snapshot: Optional[Dict[str, list]] = None):
+        """
+        :param smiley_emojis_snapshot: The snapshot read by `read_smiley_emojis_snapshot`, read here if not given
+        """
         global cog
         cog = self
         self.bot = bot
 
         self.db = db
         self.smiley_emojis_dict = dict()
+        self._smiley_emojis_dict_ready = False
+        # Emoji guilds updated while the dictionary is set up, it may have read them before the update
+        self._emoji_guilds_updated_during_setup: Optional[Set[int]] = None
+        self._refreshing_remote_emoji_guilds: Optional[asyncio.Task] = None
+        self.smiley_index = SmileyIndex({}, (), {})
+        self.reaction_words_matcher = WordMatcher(())
+        self._matchers_config_version = None
+        self.refresh_matchers()
+
+        # Answer with the last known smileys until the live ones are fetched
+        if smiley_emojis_snapshot is None:
+            smiley_emojis_snapshot = self.read_smiley_emojis_snapshot()
+        if smiley_emojis_snapshot:
+            self._set_smiley_emojis_dict(smiley_emojis_snapshot)
 
         self.bot.remove_command("help")
 
-    async def _get_all_smiley_emojis(self) -> AsyncIterator[Emoji]:
-        emoji_guilds: Iterator[Guild] = (
-            self.bot.get_guild(int(guild_id))
-            for guild_id in self.db.config["emoji_guilds_id"]
-            if self.bot.get_guild(int(guild_id))
-        )
+    async def _get_emoji_guild(self, guild_id: int) -> Optional[Guild]:
+        if guild := self.bot.get_guild(guild_id):
+            return guild
 
-        for guild in emoji_guilds:
-            for emoji_ in await guild.fetch_emojis():
-                yield emoji_
+        # The guild may be on the shards of another cluster worker
+        with suppress(discord.HTTPException):
+            return await self.bot.fetch_guild(guild_id)
 
-    async def setup_smiley_emojis_dict(self):
+    async def _get_guild_emojis(self, guild: Guild) -> Sequence[Emoji]:
+        # Emojis are cached from the gateway, unless the emojis intent is off
+        if guild.emojis:
+            return guild.emojis
+
+        return await guild.fetch_emojis()
+
+    def _is_emoji_guild(self, guild: Guild) -> bool:
+        return any(int(guild_id) == guild.id for guild_id in self.db.config["emoji_guilds_id"])
+
+    @staticmethod
+    def _add_smiley_emojis(smiley_emojis_dict: Dict[str, list], emojis: Iterable[Emoji]) -> int:
         """
-        Set up dictionary of smiley emojis.
+        Add the smiley emojis among the emojis to the dictionary.
+        :return: Count of smiley emojis added.
         """
-        new_smiley_emojis_dict = {}
-
         counter = 0
-        async for smiley_emoji in self._get_all_smiley_emojis():
+        for smiley_emoji in emojis:
             smiley_name_parts = split_smiley_emoji_name_into_parts(smiley_emoji.name)
             if smiley_name_parts is None:
                 continue
 
             smiley_name, _ = smiley_name_parts
-            new_smiley_emojis_dict.setdefault(smiley_name, []).append(smiley_emoji)
+            smiley_emojis_dict.setdefault(smiley_name, []).append(smiley_emoji)
 
             counter += 1
 
-        self.smiley_emojis_dict = new_smiley_emojis_dict
+        return counter
+
+    def _set_smiley_emojis_dict(self, smiley_emojis_dict: Dict[str, list]):
+        # Swap whole objects, so lookups never see a half built dictionary
+        self.smiley_emojis_dict = smiley_emojis_dict
+        self.rebuild_smiley_index()
+
+    @staticmethod
+    def read_smiley_emojis_snapshot() -> Optional[Dict[str, list]]:
+        """
+        Read the smiley emojis dictionary from the snapshot file, as partial emojis.
+        Doesn't touch the bot, so it can be read in a thread while starting up.
+        """
+        try:
+            with open(SMILEY_EMOJIS_SNAPSHOT_FILENAME, 'r') as f:
+                snapshot: Dict[str, list] = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logger.exception("Smiley emojis snapshot is corrupted.")
+            return None
+
+        logger.info(f"Read {sum(map(len, snapshot.values()))} smiley emojis from snapshot.")
+        return {
+            smiley_name: [
+                discord.PartialEmoji(name=emoji_name, id=emoji_id, animated=animated)
+                for emoji_name, emoji_id, animated in smiley_emojis]
+            for smiley_name, smiley_emojis in snapshot.items()}
+
+    def _save_smiley_emojis_snapshot(self, smiley_emojis_dict: Dict[str, list]):
+        snapshot = {
+            smiley_name: [[e.name, e.id, e.animated] for e in smiley_emojis]
+            for smiley_name, smiley_emojis in smiley_emojis_dict.items()}
+
+        # Write to a temporary file first, a crash mid-write mustn't leave a corrupted snapshot.
+        # Cluster workers write their own temporary files
+        temp_filename = f"{SMILEY_EMOJIS_SNAPSHOT_FILENAME}.{os.getpid()}.tmp"
+        with open(temp_filename, 'w') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+        os.replace(temp_filename, SMILEY_EMOJIS_SNAPSHOT_FILENAME)
+
+    async def save_smiley_emojis_snapshot(self):
+        try:
+            await asyncio.to_thread(self._save_smiley_emojis_snapshot, self.smiley_emojis_dict)
+        except OSError:
+            logger.exception("Failed saving smiley emojis snapshot.")
+
+    async def setup_smiley_emojis_dict(self):
+        """
+        Set up dictionary of smiley emojis.
+        """
+        self._emoji_guilds_updated_during_setup = set()
+        try:
+            counter = await self._build_smiley_emojis_dict()
+        finally:
+            updated_guild_ids, self._emoji_guilds_updated_during_setup = self._emoji_guilds_updated_during_setup, None
+
+        # The gateway cache has the emojis of the last update
+        for guild_id in updated_guild_ids:
+            if guild := self.bot.get_guild(guild_id):
+                await self._replace_guild_smiley_emojis(guild, guild.emojis)
 
         logger.info(f"Detected {counter} smiley emojis.")
 
+    async def _build_smiley_emojis_dict(self) -> int:
+        emoji_guilds = [
+            guild for guild in await asyncio.gather(*(
+                self._get_emoji_guild(int(guild_id)) for guild_id in self.db.config["emoji_guilds_id"]))
+            if guild]
+        guilds_emojis = await asyncio.gather(*map(self._get_guild_emojis, emoji_guilds))
+
+        new_smiley_emojis_dict = {}
+        counter = sum(
+            self._add_smiley_emojis(new_smiley_emojis_dict, guild_emojis)
+            for guild_emojis in guilds_emojis)
+        self._set_smiley_emojis_dict(new_smiley_emojis_dict)
+        await self.save_smiley_emojis_snapshot()
+        return counter
+
+    def rebuild_smiley_index(self):
+        """
+        Rebuild the smiley index from the configuration and the smiley emojis registry.
+        """
+        self.smiley_index = SmileyIndex(
+            SCANNED_EMOJI_UNICODE_TO_NAME,
+            self.db.static_data["smileys"],
+            self.smiley_emojis_dict)
+
+    def refresh_matchers(self):
+        """
+        Rebuild the smiley index and the reaction words matcher if the configuration has changed since they were built.
+        """
+        if self._matchers_config_version == self.db.config_version:
+            return
+
+        self.rebuild_smiley_index()
+        self.reaction_words_matcher = WordMatcher(
+            self.db.get_global_default_setting("random_reactions_chances"))
+        self._matchers_config_version = self.db.config_version
+
+    def _are_guild_smiley_emojis_changed(self, guild: Guild, emojis: Iterable[Emoji]) -> bool:
+        known_emojis = {
+            (e.id, e.name) for smiley_emojis in self.smiley_emojis_dict.values() for e in smiley_emojis
+            if getattr(e, "guild_id", None) == guild.id}
+        current_emojis = {(e.id, e.name) for e in emojis if split_smiley_emoji_name_into_parts(e.name)}
+        return known_emojis != current_emojis
+
+    async def reconcile_local_emoji_guilds(self, shard_id: Optional[int] = None):
+        """
+        Update the smiley emojis of the emoji guilds on the shards of this process from the gateway cache.
+        Emoji updates made while a shard reconnected with a new session aren't dispatched,
+        but its guilds are cached again by the time it's ready.
+        :param shard_id: Only the emoji guilds of this shard, None for all of them
+        """
+        # Without the intent the gateway doesn't cache emojis
+        if not self.bot.intents.emojis_and_stickers:
+            return
+
+        for guild_id in self.db.config["emoji_guilds_id"]:
+            guild = self.bot.get_guild(int(guild_id))
+            if not guild or (shard_id is not None and guild.shard_id != shard_id):
+                continue
+
+            if self._are_guild_smiley_emojis_changed(guild, guild.emojis):
+                await self._replace_guild_smiley_emojis(guild, guild.emojis)
+
+    async def refresh_remote_emoji_guilds(self):
+        """
+        Refetch the smiley emojis of the emoji guilds that aren't on the shards of this process.
+        Their emoji updates are dispatched to other cluster workers, and `s!update` only updates the worker running it.
+        """
+        for guild_id in self.db.config["emoji_guilds_id"]:
+            if self.bot.get_guild(int(guild_id)):
+                continue
+
+            guild = await self._get_emoji_guild(int(guild_id))
+            if not guild:
+                continue
+
+            emojis = await self._get_guild_emojis(guild)
+            if self._are_guild_smiley_emojis_changed(guild, emojis):
+                await self._replace_guild_smiley_emojis(guild, emojis)
+
+    async def refresh_remote_emoji_guilds_periodically(self):
+        while True:
+            await asyncio.sleep(REMOTE_EMOJI_GUILDS_REFRESH_INTERVAL)
+            try:
+                await self.refresh_remote_emoji_guilds()
+            except Exception:
+                logger.exception("Failed refreshing the smiley emojis of remote emoji guilds.")
+
     @commands.Cog.listener()
     async def on_ready(self):
-        await self.setup_smiley_emojis_dict()
+        # After reconnecting the dictionary is reconciled with the gateway cache, without fetching
+        if not self._smiley_emojis_dict_ready:
+            await self.setup_smiley_emojis_dict()
+            self._smiley_emojis_dict_ready = True
+        else:
+            await self.reconcile_local_emoji_guilds()
+
+        if self.bot.cluster and self._refreshing_remote_emoji_guilds is None:
+            self._refreshing_remote_emoji_guilds = self.bot.loop.create_task(
+                self.refresh_remote_emoji_guilds_periodically())
+
+    @commands.Cog.listener()
+    async def on_shard_ready(self, shard_id: int):
+        # Shards are ready before the bot is when it starts up
+        if self._smiley_emojis_dict_ready:
+            await self.reconcile_local_emoji_guilds(shard_id)
+
+    @commands.Cog.listener()
+    async def on_guild_emojis_update(self, guild: Guild, before: Sequence[Emoji], after: Sequence[Emoji]):
+        """
+        Update the smiley emojis of the guild in the dictionary, instead of setting it up again.
+        """
+        if not self._is_emoji_guild(guild):
+            return
+
+        if self._emoji_guilds_updated_during_setup is not None:
+            self._emoji_guilds_updated_during_setup.add(guild.id)
+            return
+
+        # Updates before the dictionary is first set up are read with it
+        if not self._smiley_emojis_dict_ready:
+            return
+
+        await self._replace_guild_smiley_emojis(guild, after)
+
+    async def _replace_guild_smiley_emojis(self, guild: Guild, emojis: Iterable[Emoji]):
+        new_smiley_emojis_dict = {}
+        for smiley_name, smiley_emojis in self.smiley_emojis_dict.items():
+            other_guilds_smiley_emojis = [e for e in smiley_emojis if e.guild_id != guild.id]
+            if other_guilds_smiley_emojis:
+                new_smiley_emojis_dict[smiley_name] = other_guilds_smiley_emojis
+
+        self._add_smiley_emojis(new_smiley_emojis_dict, emojis)
+        self._set_smiley_emojis_dict(new_smiley_emojis_dict)
+        await self.save_smiley_emojis_snapshot()
+
+        logger.info(f"Updated smiley emojis of {guild.name}.")
 
     @commands.Cog.listener()
     async def on_command_error(self, ctx: commands.Context, error: commands.CommandError):
@@ -250,12 +488,7 @@ class FreeSmileyDealerCog(commands.Cog):
                 raise error
 
     def get_emoji_name_from_unicode(self, emoji_unicode: str) -> str:
-        if emoji_unicode in DISCORD_EMOJI_TO_CODE:
-            emoji_name: str = DISCORD_EMOJI_TO_CODE[emoji_unicode]
-        else:
-            emoji_name: str = EMOJI_TO_ALIAS[emoji_unicode]
-
-        return emoji_name.replace(':', '').replace('-', '_')
+        return EMOJI_UNICODE_TO_NAME[emoji_unicode]
 
     def get_smiley_name(self, emoji_name: str) -> str:
         """
@@ -265,12 +498,7 @@ class FreeSmileyDealerCog(commands.Cog):
         :param emoji_name: Name of the emoji.
         :return: Name of the smiley (that is in smiley_emojis_dict)
         """
-        # Iterate emojis in data
-        for emoji_names in self.db.static_data["smileys"]:
-            if emoji_name in emoji_names:
-                return emoji_names[0]
-
-        return emoji_name
+        return self.smiley_index.get_smiley_name(emoji_name)
 
     def get_smiley_reaction_emoji(self, emoji_name: str) -> Optional[discord.Emoji]:
         """
@@ -295,39 +523,27 @@ class FreeSmileyDealerCog(commands.Cog):
         return self.get_smiley_reaction_emoji(emoji_name)
 
     @commands.Cog.listener()
+    @STAGE_SECONDS.time(stage="on_message")
     async def on_message(self, message: discord.Message):
-        # Check if message executes command
-        ctx: commands.Context = await self.bot.get_context(message)
-        if not ctx.valid and ctx.message.content:
-            # Invoke command to answer with appropriate smiley
-            new_message = copy.copy(message)
-            new_message.content = message.content
-            new_ctx: commands.Context = await self.bot.get_context(new_message)
-            command: commands.Command = self.bot.get_command("_on_message")
-            new_ctx.command = command
-            await self.bot.invoke(new_ctx)
-
-    async def react_to_words(self, ctx: commands.Context):
+        # Commands are handled by the bot itself
+        if not message.content or await self.bot.is_command_message(message):
+            return
+
+        with trace_queries("on_message", message.id):
+            await self.process_smileys(message)
+
+    @STAGE_SECONDS.time(stage="react_to_words")
+    async def react_to_words(self, message: discord.Message, settings: ScopeSettings):
         """
         React to words by chance.
         Example: If someone types out "FRIDAY", the bot will has a chance
          to reply with a friday smiley.
         """
-        chances_dict_setting = self.db.Setting("random_reactions_chances")
-        chances_dict: Optional[Dict[str, int]] = None
-
-        random_reaction_words = (
-            self.db.get_global_default_setting("random_reactions_chances").keys())
+        chances_dict: Dict[str, int] = self.db.get_global_default_setting("random_reactions_chances")
 
         smiley_emojis = []
-        regex_pattern = '|'.join(fr'(?:\b{word}\b)' for word in random_reaction_words)
-        reaction_words = (
-            match.group().lower()
-            for match in re.finditer(regex_pattern, ctx.message.content, re.IGNORECASE))
-
+        reaction_words = self.reaction_words_matcher.iter_matches(message.content)
         for random_reaction_name in iter_unique_values(reaction_words):
-            # Read random_reactions_chances setting if not read yet
-            chances_dict = chances_dict or await chances_dict_setting.read()
             chances = chances_dict[random_reaction_name]
 
             if not chance(chances):
@@ -336,102 +552,157 @@ class FreeSmileyDealerCog(commands.Cog):
             smiley_emojis.append(self.get_smiley_reaction_emoji(random_reaction_name))
 
         if smiley_emojis:
-            await self.send_smileys_based_on_mode(
-                ctx,
-                smiley_emojis,
-                always_no_title=True)
+            self.queue_smileys(message, smiley_emojis, settings, always_no_title=True)
+
+    def format_smiley_emojis(
+            self,
+            message: discord.Message,
+            emojis: Iterable[discord.Emoji],
+            *, add_title=True) -> List[str]:
+        """
+        Format the messages that send smiley emojis with a title (not lite-mode).
+        """
+        smileys_content = ' '.join(str(emoji) for emoji in emojis)
+        if not add_title:
+            return [smileys_content]
+
+        title = random.choice(self.db.static_data['titles'])
+        title_content = f"{message.author.mention} {title}"
+
+        # Send the title and the smileys in one message if they fit
+        if len(title_content) + 1 + len(smileys_content) <= extensions.MESSAGE_CHARACTER_LIMIT:
+            return [f"{title_content}\n{smileys_content}"]
+
+        return [title_content, smileys_content]
 
     async def send_smiley_emojis(
             self,
-            ctx: commands.Context,
+            message: discord.Message,
             emojis: Iterable[discord.Emoji],
             *, add_title=True):
         """
         Send smiley emojis with a title (not lite-mode).
         """
-        if add_title:
-            title = random.choice(self.db.static_data['titles'])
-            await ctx.send(f"{ctx.author.mention} {title}")
+        for content in self.format_smiley_emojis(message, emojis, add_title=add_title):
+            await message.channel.send(content)
 
-        await ctx.send(' '.join(str(emoji) for emoji in emojis))
+    @STAGE_SECONDS.time(stage="send_smileys")
+    async def send_smileys_text(self, channel: discord.abc.Messageable, mode: Mode, text: str):
+        """
+        Send formatted smiley emojis, of one response or more merged together.
+        """
+        RESPONSES.inc(mode=mode.name)
+        await channel.send(text)
 
-    async def react_with_emojis(self, ctx: commands.Context,
+    async def react_with_emojis(self, message: discord.Message,
                                 emojis: Iterable[discord.Emoji]):
         """
         React with smiley emojis (lite-mode).
         """
-        for emoji in emojis:
-            await ctx.message.add_reaction(emoji)
+        await extensions.add_reactions(message, emojis)
 
+    @STAGE_SECONDS.time(stage="send_smileys")
     async def send_smileys_based_on_mode(
             self,
-            ctx: commands.Context,
+            message: discord.Message,
             smiley_emojis: Iterable[discord.Emoji],
+            settings: ScopeSettings,
             *, always_no_title: bool = False):
         """
         Send smileys based on mode in settings.
-        :param ctx:
+        :param message: The message that is answered.
         :param smiley_emojis:
+        :param settings: The effective settings of the message's channel.
         :param always_no_title: Don't add titles, no matter what's the mode.
         """
-        mode = await self.db.Setting("mode", ctx.guild.id, ctx.channel.id).read()
+        mode = settings.mode
 
         # Reaction mode
         if mode == Mode.reaction:
-            await self.react_with_emojis(ctx, smiley_emojis)
+            RESPONSES.inc(mode=Mode.reaction.name)
+            await self.react_with_emojis(message, smiley_emojis)
 
         else:
             # Simple mode (no titles)
             if mode == Mode.simple or always_no_title:
-                await self.send_smiley_emojis(ctx, smiley_emojis, add_title=False)
+                RESPONSES.inc(mode=Mode.simple.name)
+                await self.send_smiley_emojis(message, smiley_emojis, add_title=False)
 
             # Title mode
             else:  # mode == Mode.title
-                await self.send_smiley_emojis(ctx, smiley_emojis)
+                RESPONSES.inc(mode=Mode.title.name)
+                await self.send_smiley_emojis(message, smiley_emojis)
 
-    @extensions.command(name="_on_message", hidden=True)
-    @commands.guild_only()
-    @is_enabled()
-    @author_not_muted()
-    async def command__on_message(self, ctx: commands.Context, *, message_content):
+    def queue_smileys(
+            self,
+            message: discord.Message,
+            smiley_emojis: Iterable[discord.Emoji],
+            settings: ScopeSettings,
+            *, always_no_title: bool = False):
+        """
+        Queue the smileys in the outbound queue of the message's channel.
+        Smileys that wait too long in a flooded channel are dropped,
+        and smileys sent in one message are merged with the ones queued after them.
+        """
+        created_at = message.created_at.timestamp()
+        if settings.mode != Mode.reaction:
+            mode = Mode.simple if settings.mode == Mode.simple or always_no_title else Mode.title
+            contents = self.format_smiley_emojis(message, smiley_emojis, add_title=mode == Mode.title)
+            if len(contents) == 1:
+                self.bot.outbound.submit_text(
+                    message.channel.id, contents[0],
+                    lambda text: self.send_smileys_text(message.channel, mode, text),
+                    created_at=created_at)
+                return
+
+        self.bot.outbound.submit(
+            message.channel.id,
+            lambda: self.send_smileys_based_on_mode(
+                message, smiley_emojis, settings, always_no_title=always_no_title),
+            created_at=created_at)
+
+    @STAGE_SECONDS.time(stage="process_smileys")
+    async def process_smileys(self, message: discord.Message):
+        """
+        Answer a message that is not a command with the appropriate smileys.
+        """
         # Check if not myself or user not a bot
-        if ctx.author == self.bot.user or ctx.author.bot:
+        if message.author == self.bot.user or message.author.bot:
             return
 
-        smiley_names_generator = iter_unique_values((
-            self.get_smiley_name(self.get_emoji_name_from_unicode(emoji_unicode))
-            for emoji_unicode in iterate_emojis_in_string(message_content)))
+        # Smileys are only dealt in guilds
+        if not message.guild:
+            return
 
-        smiley_emojis_generator = (
-            self.get_smiley_reaction_emoji(smiley_name)
-            for smiley_name in smiley_names_generator)
+        # Drop messages with nothing to answer before reading any settings
+        self.refresh_matchers()
+        with STAGE_SECONDS.time(stage="prefilter"):
+            may_answer = (self.smiley_index.may_contain_smileys(message.content) or
+                          self.reaction_words_matcher.has_match(message.content))
+        if not may_answer:
+            return
 
-        smiley_emojis = await aiolist(
-            islice(
-                (smiley_emoji for smiley_emoji in smiley_emojis_generator if
-                 smiley_emoji),
-                await self.db.Setting("max_smileys", ctx.guild.id,
-                                      ctx.channel.id).read()))
+        settings = await self.db.get_channel_settings(message.guild.id, message.channel.id)
 
-        # Check if there any emojis in message
-        if not smiley_emojis:
-            await self.react_to_words(ctx)
+        # Check if channel is not blacklisted
+        if settings.enabled is False:
             return
 
-        await self.send_smileys_based_on_mode(ctx, smiley_emojis)
+        # Check if author is not muted
+        if message.author.id in (settings.muted_users or ()):
+            return
 
-    @command__on_message.error
-    async def command__on_message_error(self, ctx: commands.Context,
-                                        error: commands.CommandError):
-        # Raise on this error
-        if isinstance(error, commands.CommandInvokeError):
-            # Except when there's this error in it
-            if isinstance(error.original, discord.Forbidden):
-                return
+        with STAGE_SECONDS.time(stage="scan"):
+            smiley_emojis = [
+                random.choice(smiley_candidates)
+                for _, smiley_candidates in self.smiley_index.scan(message.content, settings.max_smileys)]
 
-            raise error
+        # Check if there any emojis in message
+        if not smiley_emojis:
+            await self.react_to_words(message, settings)
+            return
 
-        return
+        self.queue_smileys(message, smiley_emojis, settings)
 
     @extensions.command(name="help", aliases=["h"])
     async def command_help(self, ctx: commands.Context,
@@ -487,7 +758,7 @@ class FreeSmileyDealerCog(commands.Cog):
             return
 
         # Send message to channel
-        heart_emoji = self.smiley_emojis_dict["heart"][0]
+        heart_emoji = self.smiley_emojis_dict.get("heart", [":heart:"])[0]
         help_message = (
             f":heart: -> {heart_emoji} If you use paid smileys (emojis) in your message, I will correct you.\n"
             "Type `:joy:` to try it out!\n")
@@ -0,0 +1,180 @@
+import re
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import discord
+
+Smiley = Tuple[str, Sequence[discord.Emoji]]
+
+# Key of the value of a trie node that completes an emoji, never a character
+_TRIE_TERMINAL = ''
+REGEX_WORD = re.compile(r'\w+')
+
+
+def _compile_first_chars_pattern(trie: Dict) -> re.Pattern:
+    """
+    Compile a pattern finding possible starts of emojis.
+    Regex character sets with many scattered characters are matched slowly, so the pattern matches
+    the latin-1 first characters exactly, and a single range covering all the other ones.
+    The trie walk rejects the extra characters.
+    """
+    first_chars = sorted(trie)
+    if not first_chars:
+        return re.compile("(?!)")
+
+    latin1_chars = ''.join(re.escape(char) for char in first_chars if ord(char) < 0x100)
+    other_chars = [char for char in first_chars if ord(char) >= 0x100]
+    other_chars_range = f"{re.escape(other_chars[0])}-{re.escape(other_chars[-1])}" if other_chars else ""
+    return re.compile(f"[{latin1_chars}{other_chars_range}]")
+
+
+class SmileyIndex:
+    """
+    Index of the smileys by the unicode of the emojis they correct.
+    It is built once from the configuration and the smiley emojis registry, and never mutated afterwards,
+    so it can be swapped atomically when either of them changes.
+    """
+
+    def __init__(
+            self,
+            emoji_names: Dict[str, str],
+            smileys: Iterable[Sequence[str]],
+            smiley_emojis: Dict[str, List[discord.Emoji]]):
+        """
+        :param emoji_names: Name of every known emoji by its unicode.
+        :param smileys: Lists of emoji names, the first name of each list is the smiley name.
+        :param smiley_emojis: Smiley emojis registry, smiley emojis by smiley name.
+        """
+        # First list an emoji name appears in wins
+        self.smiley_names: Dict[str, str] = {}
+        for emoji_names_of_smiley in smileys:
+            for emoji_name in emoji_names_of_smiley:
+                self.smiley_names.setdefault(emoji_name, emoji_names_of_smiley[0])
+
+        self.smileys: Dict[str, Smiley] = {}
+        for emoji_unicode, emoji_name in emoji_names.items():
+            smiley_name = self.get_smiley_name(emoji_name)
+            if smiley_emojis.get(smiley_name):
+                self.smileys[emoji_unicode] = (smiley_name, smiley_emojis[smiley_name])
+
+        # Emojis without a smiley are kept in the trie so they still shadow
+        # shorter emojis inside them (a flag made with a ZWJ sequence is not a rainbow)
+        self._trie: Dict = {}
+        for emoji_unicode in emoji_names:
+            node = self._trie
+            for char in emoji_unicode:
+                node = node.setdefault(char, {})
+            node[_TRIE_TERMINAL] = self.smileys.get(emoji_unicode)
+
+        self._find_emoji_start = _compile_first_chars_pattern(self._trie).search
+        self._smiley_first_chars = frozenset(emoji_unicode[0] for emoji_unicode in self.smileys)
+
+    def get_smiley_name(self, emoji_name: str) -> str:
+        """
+        Get the name of the smiley from the name of the emoji.
+        "calendar" -> "friday"
+        "face_vomiting" -> "nauseated"
+        """
+        return self.smiley_names.get(emoji_name, emoji_name)
+
+    def get(self, emoji_unicode: str) -> Optional[Smiley]:
+        """
+        Get the smiley name and its candidate smiley emojis from the unicode of an emoji.
+        Returns None if the emoji has no smiley.
+        """
+        return self.smileys.get(emoji_unicode)
+
+    def may_contain_smileys(self, string: str) -> bool:
+        """
+        Quick check for characters that can start an emoji with a smiley.
+        False means the string surely has no smileys.
+        """
+        return not self._smiley_first_chars.isdisjoint(string)
+
+    def scan(self, string: str, limit: Optional[int] = None) -> List[Smiley]:
+        """
+        Find the unique smileys of the emojis in a string, in order of appearance.
+        Emojis are matched left to right by longest match, like `emojis.iter`.
+        :param string: The string to scan.
+        :param limit: Stop scanning once this many smileys are found.
+        :return: The smiley name and candidate smiley emojis of each smiley found.
+        """
+        smileys = []
+        if limit is not None and limit <= 0:
+            return smileys
+
+        seen_smiley_names = set()
+        string_length = len(string)
+        find_emoji_start = self._find_emoji_start
+
+        match = find_emoji_start(string)
+        while match:
+            position = match.start()
+
+            # Walk the trie for the longest emoji starting here
+            node = self._trie
+            emoji_end = None
+            smiley = None
+            index = position
+            while index < string_length:
+                node = node.get(string[index])
+                if node is None:
+                    break
+                index += 1
+                if _TRIE_TERMINAL in node:
+                    emoji_end = index
+                    smiley = node[_TRIE_TERMINAL]
+
+            if emoji_end is None:
+                match = find_emoji_start(string, position + 1)
+                continue
+
+            if smiley is not None and smiley[0] not in seen_smiley_names:
+                seen_smiley_names.add(smiley[0])
+                smileys.append(smiley)
+                if len(smileys) == limit:
+                    break
+
+            match = find_emoji_start(string, emoji_end)
+
+        return smileys
+
+
+class WordMatcher:
+    """
+    Finds words from a list in a string, as whole words and case-insensitively.
+    Words made only of word characters are found with a single tokenizing pass and set lookups,
+    so the cost doesn't grow with the number of words. Any other word falls back to a regex alternation.
+    """
+
+    def __init__(self, words: Iterable[str]):
+        self.words = frozenset(word.lower() for word in words)
+
+        self._simple_words = frozenset(word for word in self.words if REGEX_WORD.fullmatch(word))
+        other_words = self.words - self._simple_words
+        self._other_words_regex: Optional[re.Pattern] = re.compile(
+            '|'.join(fr'(?:\b{re.escape(word)}\b)' for word in sorted(other_words, key=len, reverse=True)),
+            re.IGNORECASE) if other_words else None
+
+    def _iter_match_spans(self, string: str) -> Iterator[Tuple[int, str]]:
+        simple_words = self._simple_words
+        if simple_words:
+            for match in REGEX_WORD.finditer(string):
+                word = match.group().lower()
+                if word in simple_words:
+                    yield match.start(), word
+
+        if self._other_words_regex:
+            for match in self._other_words_regex.finditer(string):
+                yield match.start(), match.group().lower()
+
+    def iter_matches(self, string: str) -> Iterator[str]:
+        """
+        Iterate the words found in the string, lowercase and in order of appearance.
+        """
+        if not self._other_words_regex:
+            return (word for _, word in self._iter_match_spans(string))
+
+        return (word for _, word in sorted(self._iter_match_spans(string), key=lambda span: span[0]))
+
+    def has_match(self, string: str) -> bool:
+        return next(self._iter_match_spans(string), None) is not None
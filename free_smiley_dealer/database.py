@@ -1,32 +1,126 @@
 import asyncio
-from collections import OrderedDict
+import itertools
+import logging
+import uuid
 from typing import *
 
-from discord.ext import commands
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
+import metrics
+from cache import LRUCache, MISSING
 from cogs.smileydealer.converters import Default
+from guild_settings import GuildSettings, ScopeSettings
 
+# Defaults
+GUILD_CACHE_SIZE = 10_000
+GUILD_CACHE_TTL = 600
+WARM_UP_CHUNK_SIZE = 500
+WRITE_FLUSH_INTERVAL = 2
 
-def is_enabled():
-    async def predicate(ctx: commands.Context):
-        if not ctx.guild:
-            return True
+logger = logging.getLogger(__name__)
 
-        return await ctx.cog.db.Setting("enabled", ctx.guild.id, ctx.channel.id).read() is not False
+# Metrics
+DATABASE_SECONDS = metrics.Histogram(
+    "smiley_dealer_database_seconds", "Seconds of database calls, cached or not.", ("operation",))
+MONGO_QUERIES = metrics.Counter(
+    "smiley_dealer_mongo_queries_total", "Queries sent to mongodb.", ("operation",))
 
-    return commands.check(predicate)
 
+class _CachedGuild:
+    """
+    Guild settings in cache, along with the effective settings resolved from them per channel
+    """
+    __slots__ = ("settings", "config_version", "channel_settings")
+
+    def __init__(self, settings: Optional[GuildSettings]):
+        """
+        :param settings: None - If the guild has no document
+        """
+        self.settings = settings
+        self.config_version = 0
+        self.channel_settings: Dict[Optional[int], ScopeSettings] = {}
+
+    @classmethod
+    def from_document(cls, document: Optional[Dict]) -> "_CachedGuild":
+        return cls(GuildSettings.from_document(document) if document is not None else None)
+
+
+class _PendingUpdate:
+    """
+    Update operations of a guild document waiting to be written, coalesced into a single update.
+    $push and $pull values are always kept in their `$each` and `$in` forms, so they can be merged.
+    """
 
-def author_not_muted():
-    async def predicate(ctx: commands.Context):
-        if not ctx.guild:
-            return True
+    def __init__(self, upsert: bool):
+        self.upsert = upsert
+        self.update: Dict[str, Dict[str, Any]] = {}
 
-        muted_users = await ctx.cog.db.Setting("muted_users", ctx.guild.id, ctx.channel.id).read() or []
-        return ctx.author.id not in muted_users
+    def _paths_conflict(self, path: str, *, allowed_operators: Container[str]) -> bool:
+        for operator, fields in self.update.items():
+            if operator in allowed_operators:
+                continue
+            for other_path in fields:
+                if other_path == path or other_path.startswith(f"{path}.") or path.startswith(f"{other_path}."):
+                    return True
 
-    return commands.check(predicate)
+        return False
+
+    def merge(self, operator: str, path: str, value: Any, upsert: bool) -> bool:
+        """
+        Merge an operation into the update, unless it can't be expressed in the same update.
+        :return: Whether the operation was merged
+        """
+        if upsert != self.upsert:
+            return False
+
+        if operator in ("$set", "$unset"):
+            # Later value of a field replaces the earlier one
+            if self._paths_conflict(path, allowed_operators=("$set", "$unset")):
+                return False
+            for fields in self.update.values():
+                fields.pop(path, None)
+            self.update.setdefault(operator, {})[path] = value
+
+        else:  # operator in ("$push", "$pull")
+            if self._paths_conflict(path, allowed_operators=(operator,)):
+                return False
+            values_key = "$each" if operator == "$push" else "$in"
+            self.update.setdefault(operator, {}).setdefault(path, {values_key: []})[values_key].extend(
+                value[values_key])
+
+        return True
+
+    def to_update_one(self, guild_id: int, write_id: str) -> UpdateOne:
+        """
+        :param write_id: Stamped on the document, tells the writing process its own writes apart
+        """
+        update = {operator: fields for operator, fields in self.update.items() if fields}
+        update["$set"] = {**update.get("$set", {}), "updated_by": write_id}
+        update["$currentDate"] = {"updated_at": True}
+        return UpdateOne({"_id": str(guild_id)}, update, upsert=self.upsert)
+
+
+def _apply_update(document: Dict, update: Dict[str, Dict[str, Any]]):
+    """
+    Apply an update with $set/$unset/$push/$pull operators to a document, like mongodb does.
+    """
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            *parent_keys, key = path.split('.')
+            node = document
+            for parent_key in parent_keys:
+                node = node.setdefault(parent_key, {})
+
+            if operator == "$set":
+                node[key] = value
+            elif operator == "$unset":
+                node.pop(key, None)
+            elif operator == "$push":
+                node.setdefault(key, []).extend(value["$each"])
+            elif operator == "$pull" and key in node:
+                node[key] = [item for item in node[key] if item not in value["$in"]]
 
 
 class Database:
@@ -34,37 +128,160 @@ class Database:
     Class representing a mongodb database
     """
 
-    def __init__(self, mongo_db: AsyncIOMotorDatabase):
+    def __init__(self, mongo_db: AsyncIOMotorDatabase, *,
+                 cache_size: int = GUILD_CACHE_SIZE, cache_ttl: Optional[float] = GUILD_CACHE_TTL):
+        """
+        The configurations are loaded by `update_configurations`, or use `create`.
+        :param mongo_db: The mongodb database
+        :param cache_size: Count of guild documents to keep in cache
+        :param cache_ttl: Seconds a guild document stays in cache, None - forever
+        """
         self._db = mongo_db
 
         self.static_data = {}
         self.config = {}
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(self.update_configurations())
-
-        self._cache = OrderedDict()
+        self.config_version = 0
+        self.default_settings = ScopeSettings()
+
+        # Guilds without a document are cached too, most guilds never change a setting
+        self._cache = LRUCache(cache_size, cache_ttl)
+        # In-flight guild document queries, shared by concurrent cache misses
+        self._guild_queries: Dict[int, asyncio.Task] = {}
+        self.guild_queries_count = 0
+        self.coalesced_guild_queries_count = 0
+        # Guilds changed while warming up the cache, their fetched documents may be outdated
+        self._changed_while_warming_up: Optional[Set[int]] = None
+        # Setting changes waiting to be written, by guild
+        self._pending_updates: Dict[int, List[_PendingUpdate]] = {}
+        self._flushing_updates: Dict[int, List[_PendingUpdate]] = {}
+        self._flush_lock = asyncio.Lock()
+        # Writes of this process are stamped `<writer id>:<sequence>`, so every write changes the stamp
+        self.writer_id = uuid.uuid4().hex
+        self._write_ids = itertools.count()
         self.data_fixer_upper()
 
+    @classmethod
+    async def create(cls, mongo_db: AsyncIOMotorDatabase, **kwargs) -> "Database":
+        """
+        Create a database with its configurations loaded.
+        """
+        db = cls(mongo_db, **kwargs)
+        await db.update_configurations()
+        return db
+
+    @property
+    def mongo_db(self) -> AsyncIOMotorDatabase:
+        return self._db
+
     def Setting(self, setting_name: str, guild_id: int = None, channel_id: Optional[int] = None):
         return _Setting(self, setting_name, guild_id, channel_id)
 
-    def _verify_cache_integrity(self):
-        while len(self._cache) > 20:
-            self._cache.popitem()
+    def cache_stats(self) -> Dict[str, Any]:
+        return {
+            **self._cache.stats(),
+            "guild_queries": self.guild_queries_count,
+            "coalesced_guild_queries": self.coalesced_guild_queries_count,
+        }
 
-    async def get_guild_document(self, guild_id: int, *, cache: bool = True) -> Optional[Dict]:
+    async def _get_cached_guild(self, guild_id: int, *, cache: bool = True) -> _CachedGuild:
         # Get document from cache
         if cache:
-            doc = self._cache.get(guild_id)
-            if doc:
-                self._cache.move_to_end(guild_id, last=False)
-                return doc
+            cached_guild = self._cache.get(guild_id)
+            if cached_guild is not MISSING:
+                return cached_guild
+
+        # Get document from database, or wait for the query already in flight
+        query = self._guild_queries.get(guild_id)
+        if query is None:
+            query = self._guild_queries[guild_id] = asyncio.create_task(self._query_guild(guild_id))
+            query.add_done_callback(lambda _: self._forget_guild_query(guild_id, query))
+        else:
+            self.coalesced_guild_queries_count += 1
+
+        # One waiter being cancelled must not cancel the query of the others
+        return await asyncio.shield(query)
 
-        # Get document from database
+    @DATABASE_SECONDS.time(operation="query_guild")
+    async def _query_guild(self, guild_id: int) -> _CachedGuild:
+        self.guild_queries_count += 1
+        MONGO_QUERIES.inc(operation="find_guild")
         doc = await self._db["guilds"].find_one({"_id": str(guild_id)})
-        self._cache[guild_id] = doc
-        self._verify_cache_integrity()
-        return doc
+        cached_guild = _CachedGuild.from_document(self._apply_pending_updates(guild_id, doc))
+
+        # The guild may have been changed while querying, then the document could be outdated
+        if self._guild_queries.get(guild_id) is asyncio.current_task():
+            self._cache.set(guild_id, cached_guild)
+        return cached_guild
+
+    def _forget_guild_query(self, guild_id: int, query: asyncio.Task):
+        if self._guild_queries.get(guild_id) is query:
+            del self._guild_queries[guild_id]
+
+    def is_own_write(self, write_id: Optional[str]) -> bool:
+        """
+        Check if a write stamp of a guild document is of a write made by this process.
+        """
+        return isinstance(write_id, str) and write_id.startswith(f"{self.writer_id}:")
+
+    def invalidate_guild(self, guild_id: int):
+        """
+        Remove the guild from cache, and stop sharing its in-flight query with later reads.
+        """
+        self._cache.pop(guild_id)
+        self._guild_queries.pop(guild_id, None)
+        if self._changed_while_warming_up is not None:
+            self._changed_while_warming_up.add(guild_id)
+
+    def invalidate_all_guilds(self):
+        """
+        Remove all guilds from cache, when changes to them might have been missed.
+        """
+        for guild_id in list(self._guild_queries):
+            self.invalidate_guild(guild_id)
+        self._cache.clear()
+
+    @DATABASE_SECONDS.time(operation="warm_up_cache")
+    async def warm_up_cache(self, guild_ids: Iterable[int], *, chunk_size: int = WARM_UP_CHUNK_SIZE) -> int:
+        """
+        Preload the documents of the guilds into cache, with a query per chunk of guilds.
+        Guilds without a document are cached as such.
+        :param guild_ids: The guilds to preload, most important first. Only as many as fit in cache are loaded.
+        :param chunk_size: Count of guilds to query at once
+        :return: Count of guilds loaded
+        """
+        guild_ids = list(guild_ids)[:self._cache.capacity]
+        loaded_count = 0
+
+        self._changed_while_warming_up = set()
+        try:
+            for chunk_start in range(0, len(guild_ids), chunk_size):
+                chunk = guild_ids[chunk_start:chunk_start + chunk_size]
+                MONGO_QUERIES.inc(operation="find_guilds")
+                cursor = self._db["guilds"].find(
+                    {"_id": {"$in": [str(guild_id) for guild_id in chunk]}},
+                    {"settings": 1})
+                documents = {doc["_id"]: doc async for doc in cursor}
+
+                for guild_id in chunk:
+                    # Don't override newer data
+                    if (guild_id in self._changed_while_warming_up or
+                            guild_id in self._guild_queries or guild_id in self._cache):
+                        continue
+
+                    self._cache.set(guild_id, _CachedGuild.from_document(
+                        self._apply_pending_updates(guild_id, documents.get(str(guild_id)))))
+                    loaded_count += 1
+
+                # Let messages be handled between chunks
+                await asyncio.sleep(0)
+        finally:
+            self._changed_while_warming_up = None
+
+        return loaded_count
+
+    async def get_guild_document(self, guild_id: int, *, cache: bool = True) -> Optional[Dict]:
+        guild_settings = (await self._get_cached_guild(guild_id, cache=cache)).settings
+        return guild_settings.to_document(guild_id) if guild_settings else None
 
     def data_fixer_upper(self):
         """
@@ -75,42 +292,37 @@ class Database:
     def get_global_default_setting(self, setting_name: str):
         return self.static_data["default_settings"][setting_name]
 
-    def _get_setting_from_document(self, setting_name, document, channel_id: Optional[int] = None):
-        if not document:
-            return self.get_global_default_setting(setting_name)
-
-        # Try to get channel setting
-        if channel_id:
-            try:
-                return document["settings"][str(channel_id)][setting_name]
-            except KeyError:
-                pass
-
-        # Try to get default server setting
-        try:
-            return document["settings"]['default'][setting_name]
-        except KeyError:
-            pass
+    def _resolve_settings(self, guild_settings: Optional[GuildSettings], channel_id: Optional[int] = None) -> ScopeSettings:
+        settings = dict()
+        for setting_name, default_value in self.static_data["default_settings"].items():
+            value = guild_settings.get(setting_name, channel_id) if guild_settings else None
+            settings[setting_name] = default_value if value is None else value
 
-        return
+        return ScopeSettings.from_dict(settings)
 
-    async def _get_settings_dict(self, guild_id: Optional[int] = None, channel_id: Optional[int] = None):
+    @DATABASE_SECONDS.time(operation="get_channel_settings")
+    async def get_channel_settings(self, guild_id: Optional[int] = None, channel_id: Optional[int] = None) -> ScopeSettings:
         """
-        Gets the settings of the channel, considers default server and global
+        Gets the effective settings of the channel, considers default server and global.
+        The result is memoized per guild, channel and configuration version, so it must not be mutated.
         :param guild_id: None - If wants to get the global default settings
         :param channel_id: None - If wants to get the guild default settings
-        :return: The settings dictionary
+        :return: The resolved settings
         """
         if not guild_id:
-            return self.static_data["default_settings"]
+            return self.default_settings
 
-        guild_data = await self.get_guild_document(guild_id)
-        if not guild_data:
-            return self.static_data["default_settings"]
+        cached_guild = await self._get_cached_guild(guild_id)
+        if cached_guild.config_version != self.config_version:
+            cached_guild.channel_settings.clear()
+            cached_guild.config_version = self.config_version
 
-        settings = dict()
-        for setting_name in self.static_data["default_settings"]:
-            settings[setting_name] = self._get_setting_from_document(setting_name, guild_data, channel_id)
+        settings = cached_guild.channel_settings.get(channel_id)
+        if settings is None:
+            settings = cached_guild.channel_settings[channel_id] = self._resolve_settings(
+                cached_guild.settings, channel_id)
+
+        return settings
 
     async def _get_setting(self, setting_name: str, guild_id: Optional[int] = None, channel_id: Optional[int] = None) -> Any:
         """
@@ -120,17 +332,113 @@ class Database:
         :param channel_id: None - If wants to get the guild default setting
         :return: The setting value
         """
-        if not guild_id:
-            return self.get_global_default_setting(setting_name)
-
-        guild_data = await self.get_guild_document(guild_id)
-        value = self._get_setting_from_document(setting_name, guild_data, channel_id)
-
+        value = (await self.get_channel_settings(guild_id, channel_id)).get(setting_name)
         if value is None:
             return self.get_global_default_setting(setting_name)
 
         return value
 
+    def _apply_pending_updates(self, guild_id: int, document: Optional[Dict]) -> Optional[Dict]:
+        """
+        Apply the changes not written yet to a document fetched from the database.
+        """
+        pending_updates = self._flushing_updates.get(guild_id, []) + self._pending_updates.get(guild_id, [])
+        for pending_update in pending_updates:
+            if document is None:
+                if not pending_update.upsert:
+                    continue
+                document = {"_id": str(guild_id)}
+            _apply_update(document, pending_update.update)
+
+        return document
+
+    def _queue_update(self, guild_id: int, operator: str, path: str, value: Any, *, upsert: bool):
+        """
+        Queue a change to the guild document, and apply it to the cached document right away.
+        """
+        if operator == "$push":
+            value = {"$each": [value]}
+        elif operator == "$pull":
+            value = {"$in": [value]}
+
+        pending_updates = self._pending_updates.setdefault(guild_id, [])
+        if not pending_updates or not pending_updates[-1].merge(operator, path, value, upsert):
+            pending_update = _PendingUpdate(upsert)
+            pending_update.merge(operator, path, value, upsert)
+            pending_updates.append(pending_update)
+
+        # A query in flight may return the document without this change
+        self._guild_queries.pop(guild_id, None)
+        if self._changed_while_warming_up is not None:
+            self._changed_while_warming_up.add(guild_id)
+
+        # Patch the cached settings
+        cached_guild = self._cache.get(guild_id, count=False)
+        if cached_guild is MISSING:
+            return
+        if cached_guild.settings is None:
+            if not upsert:
+                return
+            document = {"_id": str(guild_id)}
+        else:
+            document = cached_guild.settings.to_document(guild_id)
+        _apply_update(document, {operator: {path: value}})
+        cached_guild.settings = GuildSettings.from_document(document)
+        cached_guild.channel_settings.clear()
+
+    async def flush_updates(self):
+        """
+        Write all the queued setting changes with a single bulk write.
+        Changes that failed to be written are queued again.
+        """
+        async with self._flush_lock:
+            if not self._pending_updates:
+                return
+
+            self._flushing_updates, self._pending_updates = self._pending_updates, {}
+            operations = [
+                (guild_id, pending_update)
+                for guild_id, guild_pending_updates in self._flushing_updates.items()
+                for pending_update in guild_pending_updates]
+
+            try:
+                MONGO_QUERIES.inc(operation="bulk_write_guilds")
+                with DATABASE_SECONDS.time(operation="bulk_write_guilds"):
+                    await self._db["guilds"].bulk_write(
+                        [pending_update.to_update_one(guild_id, f"{self.writer_id}:{next(self._write_ids)}")
+                         for guild_id, pending_update in operations],
+                        ordered=True)
+            except (Exception, asyncio.CancelledError) as e:
+                # Ordered bulk writes stop at the first write error, everything before it was written.
+                # Without write errors only the write concern failed, and all of it was written
+                if isinstance(e, BulkWriteError):
+                    write_errors = e.details.get("writeErrors")
+                    written_count = write_errors[0]["index"] if write_errors else len(operations)
+                else:
+                    written_count = 0
+
+                # Requeue before the changes made meanwhile
+                for guild_id, pending_update in reversed(operations[written_count:]):
+                    self._pending_updates.setdefault(guild_id, []).insert(0, pending_update)
+
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                logger.exception(f"Failed writing {len(operations) - written_count} setting changes, retrying later.")
+            finally:
+                # Queries sent during the write may miss some of it, don't cache their result
+                for guild_id in self._flushing_updates:
+                    self._guild_queries.pop(guild_id, None)
+                self._flushing_updates = {}
+
+    async def flush_updates_periodically(self, interval: float = WRITE_FLUSH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush_updates()
+            except Exception:
+                # The changes are still queued, they are written by the next flush
+                logger.exception("Failed flushing setting changes.")
+
     async def _delete_setting(self, setting_name: str, guild_id: int, channel_id: Optional[int] = None):
         """
         Deletes the specified setting from the database
@@ -138,15 +446,18 @@ class Database:
         :param guild_id
         :param channel_id: None - If wants to delete the guild default setting
         """
-        await self._db["guilds"].update_one(
-            {"_id": str(guild_id)},
-            {"$unset":
-                {f"settings.{str(channel_id) if channel_id else 'default'}.{setting_name}": ""}})
+        self._queue_update(
+            guild_id,
+            "$unset",
+            f"settings.{str(channel_id) if channel_id else 'default'}.{setting_name}",
+            "",
+            upsert=False)
 
     async def _change_setting(self, setting_name: str, setting_value: Any = None, *, guild_id: int, channel_id: Optional[int] = None,
                         operation="set", upsert=True):
         """
-        Changes the specified setting to the given value
+        Changes the specified setting to the given value.
+        The change is visible right away, and written to the database with the next flush.
         :param setting_name: Name of the setting
         :param setting_value: The new value of the setting
                               None - If wants to delete the setting
@@ -160,19 +471,28 @@ class Database:
             await self._delete_setting(setting_name, guild_id, channel_id)
         else:
             # Change the value of the setting
-            await self._db["guilds"].update_one(
-                {"_id": str(guild_id)},
-                {f"${operation}":
-                    {f"settings.{str(channel_id) if channel_id else 'default'}.{setting_name}": setting_value}},
+            self._queue_update(
+                guild_id,
+                f"${operation}",
+                f"settings.{str(channel_id) if channel_id else 'default'}.{setting_name}",
+                setting_value,
                 upsert=upsert)
 
-        # Remove from cache
-        if guild_id in self._cache:
-            self._cache.pop(guild_id)
+    @DATABASE_SECONDS.time(operation="fetch_configurations")
+    async def fetch_configurations(self) -> Tuple[Dict, Dict]:
+        MONGO_QUERIES.inc(2, operation="find_configuration")
+        return (
+            await self._db["configurations"].find_one({"_id": "static_data"}),
+            await self._db["configurations"].find_one({"_id": "config"}))
+
+    def apply_configurations(self, static_data: Dict, config: Dict):
+        self.static_data = static_data
+        self.config = config
+        self.default_settings = ScopeSettings.from_dict(static_data["default_settings"])
+        self.config_version += 1
 
     async def update_configurations(self):
-        self.static_data = await self._db["configurations"].find_one({"_id": "static_data"})
-        self.config = await self._db["configurations"].find_one({"_id": "config"})
+        self.apply_configurations(*await self.fetch_configurations())
 
 
 class _Setting:
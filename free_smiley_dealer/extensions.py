@@ -1,40 +1,91 @@
 import asyncio
+import concurrent.futures
 import datetime
+import heapq
+import itertools
 import logging
+import queue
+import sys
 import time
+import traceback
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
 from typing import *
 
 import discord
-from discord import Guild, TextChannel
+from discord import Guild
 from discord.ext import commands
-from discord.ext.commands import Bot
+from discord.ext.commands.view import StringView
 
+import metrics
+import query_tracing
+from cluster import ClusterWorker
 from database import Database
+from invalidation import InvalidationFeed
+from outbound import OutboundScheduler
 
 # Constants
 MESSAGE_CHARACTER_LIMIT = 2000
+UNKNOWN_EMOJI_ERROR_CODE = 10014
 T0 = time.time()
 
-__all__ = ['Command', 'command', 'BasicBot', 'DiscordChannelLoggingHandler', 'CommandConverter']
+# Defaults
+LOG_QUEUE_SIZE = 10_000
+LOG_FLUSH_INTERVAL = 5
+LOG_MAX_BUFFERED_RECORDS = 1000
+LOG_MAX_MESSAGES_PER_FLUSH = 2
+
+__all__ = ['Command', 'command', 'BasicBot', 'DiscordChannelLoggingHandler', 'DroppingQueueHandler', 'DrainingQueueListener',
+           'CommandConverter',
+           'add_reactions', 'LOG_QUEUE_SIZE']
 
 logger = logging.getLogger(__name__)
 
 
 def split_message_for_discord(content: str, divider: str = None) -> Iterable[str]:
+    """
+    Split content into messages that fit in discord, without losing any of it.
+    :param divider: Split only at the divider, unless a segment doesn't fit in a message of its own.
+                    None - If can split anywhere
+    """
     if divider is None:
-        segments = content
+        segments = [content]
     else:
         segments = [s + divider for s in content.split(divider)]
+        segments[-1] = segments[-1][:-len(divider)]
 
     message = ""
     for segment in segments:
-        if len(message) + len(segment) >= MESSAGE_CHARACTER_LIMIT:
-            yield message
+        if len(message) + len(segment) > MESSAGE_CHARACTER_LIMIT:
+            if message:
+                yield message
             message = ""
-        else:
-            message += segment
 
-    yield message
+            while len(segment) > MESSAGE_CHARACTER_LIMIT:
+                yield segment[:MESSAGE_CHARACTER_LIMIT]
+                segment = segment[MESSAGE_CHARACTER_LIMIT:]
+
+        message += segment
+
+    if message:
+        yield message
+
+
+async def add_reactions(message: discord.Message, emojis: Iterable[Union[discord.Emoji, discord.PartialEmoji, str]]):
+    """
+    Add reactions to a message one after another, so they keep their order.
+    Reactions are limited to one request per quarter second, so sending the next one
+    before the last is answered wouldn't add them any faster.
+    Emojis that no longer exist are skipped, other errors would fail the rest of the reactions too.
+    """
+    for emoji in emojis:
+        try:
+            await message.add_reaction(emoji)
+        except discord.NotFound as e:
+            if e.code != UNKNOWN_EMOJI_ERROR_CODE:
+                raise
+
+            logger.warning(f"Skipped reacting with unknown emoji {emoji}.")
 
 
 class Command(commands.Command):
@@ -56,17 +107,101 @@ def command(**kwargs):
 
 
 class BasicBot(commands.AutoShardedBot):
-    def __init__(self, intents: discord.Intents, db: Database, *args, **kwargs):
+    def __init__(self, intents: discord.Intents, db: Database, *args,
+                 outbound: Optional[OutboundScheduler] = None, cluster: Optional[ClusterWorker] = None, **kwargs):
+        """
+        :param cluster: The part of the cluster to run, all of the shards if not given
+        """
         self.db = db
+        self.outbound = outbound or OutboundScheduler()
+        self.cluster = cluster
 
         super().__init__(
-            command_prefix=commands.when_mentioned_or(self.db.config["prefix"]),
-            intents=intents
+            command_prefix=BasicBot._get_command_prefix,
+            intents=intents,
+            shard_ids=cluster.shard_ids if cluster else None,
+            shard_count=cluster.shard_count if cluster else None
         )
 
-        asyncio.get_event_loop().run_until_complete(
-            self.add_cog(BasicBot.Commands(self))
-        )
+        self._cache_warmed_up = False
+        self.invalidation_feed = InvalidationFeed(self.db)
+
+        # Queued responses wait for the commands of their channel
+        self.before_invoke(self._on_command_invoke)
+        self.after_invoke(self._on_command_invoked)
+
+        self._register_metrics()
+
+    def _register_metrics(self):
+        metrics.Gauge(
+            "smiley_dealer_guild_cache_hit_ratio", "Ratio of guild settings reads served from cache.",
+            lambda: self.db.cache_stats()["hit_ratio"])
+        metrics.Gauge(
+            "smiley_dealer_guild_cache_size", "Guilds in the settings cache.",
+            lambda: self.db.cache_stats()["size"])
+        metrics.Gauge(
+            "smiley_dealer_coalesced_guild_queries", "Guild settings reads that waited for a query in flight.",
+            lambda: self.db.coalesced_guild_queries_count)
+        metrics.Gauge(
+            "smiley_dealer_outbound_queued", "Responses waiting in the outbound queues.",
+            lambda: self.outbound.stats()["queued"])
+
+    def _get_command_prefix(self, message: discord.Message) -> List[str]:
+        # The configurations are loaded after the bot is created, and may be reloaded
+        return commands.when_mentioned_or(self.db.config["prefix"])(self, message)
+
+    async def _on_command_invoke(self, ctx: commands.Context):
+        self.outbound.command_started(ctx.channel.id)
+
+    async def _on_command_invoked(self, ctx: commands.Context):
+        self.outbound.command_finished(ctx.channel.id)
+
+    async def is_command_message(self, message: discord.Message) -> bool:
+        """
+        Check if the message invokes a command, without building a command context.
+        Parses the prefix and invoker like `commands.Bot.get_context`, `s!` alone invokes the command aliased ''.
+        """
+        prefixes = await self.get_prefix(message)
+        if isinstance(prefixes, str):
+            prefixes = (prefixes,)
+
+        view = StringView(message.content)
+        if not any(map(view.skip_string, prefixes)):
+            return False
+
+        if self.strip_after_prefix:
+            view.skip_ws()
+
+        return view.get_word() in self.all_commands
+
+    async def on_message(self, message: discord.Message):
+        # Most messages aren't commands, don't build a command context for them
+        if message.author.bot or not message.content or not await self.is_command_message(message):
+            return
+
+        await self.process_commands(message)
+
+    async def invoke(self, ctx: commands.Context):
+        # Messages that aren't commands aren't traced, they would skew the stats
+        if ctx.command is None:
+            return await super().invoke(ctx)
+
+        # Checks and converters count towards the queries of the command
+        with query_tracing.trace_queries(f"command:{ctx.command.qualified_name}", ctx.message.id):
+            await super().invoke(ctx)
+
+    async def setup_hook(self):
+        await self.add_cog(BasicBot.Commands(self))
+
+        # Keep caches in sync with other processes, the tasks keep the query scope they were created in
+        with query_tracing.trace_queries("invalidation_feed"):
+            self.loop.create_task(self.invalidation_feed.run())
+        with query_tracing.trace_queries("flush_updates"):
+            self.loop.create_task(self.db.flush_updates_periodically())
+
+    async def close(self):
+        await super().close()
+        await self.db.flush_updates()
 
     async def setup_activities(self):
         await self.wait_until_ready()
@@ -74,6 +209,36 @@ class BasicBot(commands.AutoShardedBot):
         if "activities" in self.db.config:
             self.loop.create_task(self.continuously_change_presence())
 
+    async def warm_up_cache(self):
+        """
+        Preload the settings of the connected guilds, biggest guilds first.
+        """
+        t0 = time.perf_counter()
+        guilds = sorted(self.guilds, key=lambda g: g.member_count or 0, reverse=True)
+        with query_tracing.trace_queries("warm_up_cache"):
+            loaded_count = await self.db.warm_up_cache(g.id for g in guilds)
+        logger.info(f"Warmed up settings cache with {loaded_count} guilds in {time.perf_counter() - t0:.2f}s.")
+
+    @property
+    def guilds_count(self) -> int:
+        """
+        Count of guilds of the whole cluster.
+        """
+        if not self.cluster:
+            return len(self.guilds)
+
+        return self.cluster.get_total_guilds_count()
+
+    def _share_guilds_count(self):
+        if self.cluster:
+            self.cluster.set_guilds_count(len(self.guilds))
+
+    async def on_guild_join(self, guild: Guild):
+        self._share_guilds_count()
+
+    async def on_guild_remove(self, guild: Guild):
+        self._share_guilds_count()
+
     async def on_ready(self):
         def get_member_count_of_guild(guild: Guild) -> int:
             try:
@@ -81,9 +246,15 @@ class BasicBot(commands.AutoShardedBot):
             except AttributeError:
                 return 0
 
+        # on_ready is dispatched again after reconnecting
+        if not self._cache_warmed_up:
+            self._cache_warmed_up = True
+            self.loop.create_task(self.warm_up_cache())
+
+        self._share_guilds_count()
         await self.setup_activities()
         logger.info("Bot is ready.")
-        logger.info(f"Guilds total: {len(self.guilds)}")
+        logger.info(f"Guilds total: {self.guilds_count}")
 
         guilds_sorted_by_members = sorted(
             self.guilds, key=lambda g: get_member_count_of_guild(g), reverse=True)
@@ -97,8 +268,7 @@ class BasicBot(commands.AutoShardedBot):
         def check(r: discord.Reaction, u: discord.User):
             return u == user and (r.emoji in emojis or str(r.emoji) in emojis)
 
-        for e in emojis:
-            await message.add_reaction(e)
+        await add_reactions(message, emojis)
 
         reaction = (await self.wait_for("reaction_add", timeout=timeout, check=check))[0]
         return reaction.emoji
@@ -118,7 +288,7 @@ class BasicBot(commands.AutoShardedBot):
 
             return discord.Activity(
                 type=act_type,
-                name=act_name.format(guilds_count=len(self.guilds), prefix=self.db.config["prefix"]))
+                name=act_name.format(guilds_count=self.guilds_count, prefix=self.db.config["prefix"]))
 
         while True:
             for activity_str in self.db.config["activities"]:
@@ -166,8 +336,11 @@ class BasicBot(commands.AutoShardedBot):
         async def command_log(self, ctx: commands.Context, *, to_log):
 
             shortcuts = {
-                "len": "len(self.bot.guilds)",
+                "len": "self.bot.guilds_count",
                 "names": "[g.name for g in sorted(self.bot.guilds, key=lambda g: g.member_count, reverse=True)[:50]]",
+                "cache": "self.bot.db.cache_stats()",
+                "outbound": "self.bot.outbound.stats()",
+                "queries": "query_tracing.query_stats()",
             }
 
             if to_log in shortcuts:
@@ -177,18 +350,28 @@ class BasicBot(commands.AutoShardedBot):
 
 
 class DiscordChannelLoggingHandler(logging.Handler):
-    def __init__(self, log_channel_id: int, bot: Optional[BasicBot] = None, min_level=logging.INFO):
+    """
+    Ships log records to a discord channel.
+    Records are buffered and packed into as few messages as possible every flush interval.
+    When the channel falls behind, records logged from the same place are collapsed into one summary.
+    """
+
+    def __init__(self, log_channel_id: int, bot: Optional[BasicBot] = None, min_level=logging.INFO, *,
+                 flush_interval: float = LOG_FLUSH_INTERVAL, max_buffered_records: int = LOG_MAX_BUFFERED_RECORDS):
         super().__init__()
         self.log_channel_id = log_channel_id
         self.bot = bot
         self.min_level = min_level
+        self.flush_interval = flush_interval
 
-    @staticmethod
-    async def log(bot: Bot, content: str, channel: TextChannel):
-        content = content.replace("@everyone", "`@everyone`").replace("@here", "`@here`")
+        self._records: Deque[Tuple[Hashable, str]] = deque(maxlen=max_buffered_records)
+        self._flushing = None
+        self.dropped_count = 0
+        self._unreported_dropped_count = 0
 
-        for segment in split_message_for_discord(content):
-            await channel.send(segment)
+    @staticmethod
+    def _get_similarity_key(record: logging.LogRecord) -> Hashable:
+        return record.levelno, record.pathname, record.lineno
 
     def emit(self, record: logging.LogRecord):
         if record.levelno < self.min_level:
@@ -197,12 +380,105 @@ class DiscordChannelLoggingHandler(logging.Handler):
         if not self.bot or not self.bot.is_ready():
             return
 
+        content = self.format(record).replace("@everyone", "`@everyone`").replace("@here", "`@here`")
+        if len(self._records) == self._records.maxlen:
+            self.dropped_count += 1
+            self._unreported_dropped_count += 1
+        self._records.append((self._get_similarity_key(record), content))
+
+        # Records can be logged from other threads
+        if self._flushing is None:
+            self._flushing = asyncio.run_coroutine_threadsafe(self.flush_periodically(), self.bot.loop)
+            self._flushing.add_done_callback(self._on_flushing_done)
+
+    def _on_flushing_done(self, flushing: concurrent.futures.Future):
+        # Started again by the next record
+        if self._flushing is flushing:
+            self._flushing = None
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+
+            # Failing to log mustn't stop logging. Errors aren't logged, they would be shipped here again
+            try:
+                await self.flush_to_channel()
+            except discord.HTTPException:
+                pass
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
+    async def flush_to_channel(self):
         channel = self.bot.get_channel(self.log_channel_id)
-        if not channel:
+        if not channel or not self._records:
             return
 
-        formatted_record = self.format(record)
-        self.bot.loop.create_task(self.log(self.bot, formatted_record, channel))
+        records = [self._records.popleft() for _ in range(len(self._records))]
+        contents = [content for _, content in records]
+
+        # More than the channel can take in a flush, the channel fell behind
+        if sum(len(content) + 1 for content in contents) > MESSAGE_CHARACTER_LIMIT * LOG_MAX_MESSAGES_PER_FLUSH:
+            contents = self._collapse_similar_records(records)
+
+        if self._unreported_dropped_count:
+            contents.insert(0, f"*Dropped {self._unreported_dropped_count} records, the log buffer was full.*")
+            self._unreported_dropped_count = 0
+
+        for message in split_message_for_discord("\n".join(contents), divider="\n"):
+            await channel.send(message)
+
+    @staticmethod
+    def _collapse_similar_records(records: Iterable[Tuple[Hashable, str]]) -> List[str]:
+        """
+        Collapse the records of each similarity key into its first record, in the order of first appearance.
+        """
+        similar_records: Dict[Hashable, List] = {}
+        for key, content in records:
+            if key in similar_records:
+                similar_records[key][1] += 1
+            else:
+                similar_records[key] = [content, 1]
+
+        return [
+            content if count == 1 else f"*{count} similar records, the first of them:*\n{content}"
+            for content, count in similar_records.values()]
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Queue handler for a bounded queue, so logging never blocks the event loop.
+    Records are dropped while the queue is full, and their count is logged once the queue has room again.
+    """
+
+    def __init__(self, queue_: queue.Queue):
+        super().__init__(queue_)
+        self.dropped_count = 0
+        self._unreported_dropped_count = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            if self._unreported_dropped_count:
+                self.queue.put_nowait(self.prepare(self._make_dropped_record()))
+                self._unreported_dropped_count = 0
+
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_count += 1
+            self._unreported_dropped_count += 1
+
+    def _make_dropped_record(self) -> logging.LogRecord:
+        return logging.LogRecord(
+            __name__, logging.WARNING, __file__, 0,
+            f"Dropped {self._unreported_dropped_count} log records, the log queue was full.", None, None)
+
+
+class DrainingQueueListener(QueueListener):
+    """
+    Queue listener that handles all the queued records when stopped, even if the queue is full.
+    """
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
 
 
 class CommandConverter(commands.Converter):
@@ -218,9 +494,26 @@ class CommandConverter(commands.Converter):
 
 
 class CooldownMapping(commands.CooldownMapping):
+    """
+    Cooldown mapping with buckets by several bucket types, and buckets made by a factory.
+    Buckets that weren't used in their cooldown window expire by a min-heap of their expiry times,
+    so a lookup doesn't scan all the buckets.
+    """
+
     def __init__(self, factory, bucket_type: Sequence[commands.BucketType]):
-        super().__init__(factory)
-        self._bucket_type = (bucket_type,) if not isinstance(bucket_type, commands.BucketType) else bucket_type
+        self._bucket_type = (bucket_type,) if isinstance(bucket_type, commands.BucketType) else bucket_type
+        super().__init__(factory, self._bucket_key)
+
+        # (Expiry time, Insertion count, Key), an entry for every bucket in the cache.
+        # Expiry times can be earlier than the real ones, since buckets are used after they are looked up.
+        self._expiry_heap: List[Tuple[float, int, Any]] = []
+        self._expiry_count = itertools.count()
+
+    def copy(self) -> "CooldownMapping":
+        ret = CooldownMapping(self._cooldown, self._bucket_type)
+        ret._cache = self._cache.copy()
+        ret._expiry_heap = self._expiry_heap.copy()
+        return ret
 
     def _bucket_key(self, msg):
         def get_key(bucket_type):
@@ -237,29 +530,40 @@ class CooldownMapping(commands.CooldownMapping):
 
         return frozenset(get_key(bucket_type) for bucket_type in self._bucket_type)
 
-    def _verify_cache_integrity(self):
+    def _verify_cache_integrity(self, current: Optional[float] = None):
         # we want to delete all cache objects that haven't been used
         # in a cooldown window. e.g. if we have a  command that has a
         # cooldown of 60s and it has not been used in 60s then that key should be deleted
-        current = time.time()
-        dead_keys = [k for k, v in self._cache.items() if current > v._last + v.per]
-        for k in dead_keys:
-            del self._cache[k]
+        current = current or time.time()
+        while self._expiry_heap and current > self._expiry_heap[0][0]:
+            _, _, key = heapq.heappop(self._expiry_heap)
+            bucket = self._cache[key]
 
-    def get_bucket(self, message):
-        self._verify_cache_integrity()
-        key = self._bucket_key(message)
-        if key not in self._cache:
-            if isinstance(self._cooldown, commands.Cooldown):
-                bucket = self._cooldown.copy()
-            # elif asyncio.iscoroutinefunction(self._cooldown):
-            #    bucket = await self._cooldown(message)
-            elif callable(self._cooldown):
-                bucket = self._cooldown(message)
+            expires_at = bucket._last + bucket.per
+            if current > expires_at:
+                del self._cache[key]
             else:
-                raise TypeError("Cooldown factory should be a Cooldown object/function/coroutine.")
+                # Used since it was pushed
+                heapq.heappush(self._expiry_heap, (expires_at, next(self._expiry_count), key))
+
+    def create_bucket(self, message) -> commands.Cooldown:
+        if isinstance(self._cooldown, commands.Cooldown):
+            return self._cooldown.copy()
+        # elif asyncio.iscoroutinefunction(self._cooldown):
+        #    return await self._cooldown(message)
+        elif callable(self._cooldown):
+            return self._cooldown(message)
+        else:
+            raise TypeError("Cooldown factory should be a Cooldown object/function/coroutine.")
 
+    def get_bucket(self, message, current: Optional[float] = None) -> commands.Cooldown:
+        current = current or time.time()
+        self._verify_cache_integrity(current)
+        key = self._bucket_key(message)
+        if key not in self._cache:
+            bucket = self.create_bucket(message)
             self._cache[key] = bucket
+            heapq.heappush(self._expiry_heap, (current + bucket.per, next(self._expiry_count), key))
         else:
             bucket = self._cache[key]
 
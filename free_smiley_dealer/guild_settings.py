@@ -0,0 +1,102 @@
+from typing import *
+
+
+class ScopeSettings:
+    """
+    Settings of a single scope, a channel or the server default, or the settings resolved for a channel.
+    A setting that is None is not set in this scope.
+    Settings without a slot of their own are kept in `extra`.
+    """
+    __slots__ = ("enabled", "mode", "max_smileys", "muted_users", "extra")
+    FIELDS = ("enabled", "mode", "max_smileys", "muted_users")
+
+    def __init__(
+            self,
+            enabled: Optional[bool] = None,
+            mode: Optional[int] = None,
+            max_smileys: Optional[int] = None,
+            muted_users: Optional[FrozenSet[int]] = None,
+            extra: Optional[Dict[str, Any]] = None):
+        self.enabled = enabled
+        self.mode = mode
+        self.max_smileys = max_smileys
+        self.muted_users = muted_users
+        self.extra = extra
+
+    @classmethod
+    def from_dict(cls, settings: Dict[str, Any]) -> "ScopeSettings":
+        mode = settings.get("mode")
+        max_smileys = settings.get("max_smileys")
+        muted_users = settings.get("muted_users")
+        extra = {name: value for name, value in settings.items() if name not in cls.FIELDS}
+
+        return cls(
+            enabled=settings.get("enabled"),
+            mode=int(mode) if mode is not None else None,
+            max_smileys=int(max_smileys) if max_smileys is not None else None,
+            muted_users=frozenset(muted_users) if muted_users is not None else None,
+            extra=extra or None)
+
+    def to_dict(self) -> Dict[str, Any]:
+        settings = {}
+        for name in self.FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                settings[name] = list(value) if name == "muted_users" else value
+
+        settings.update(self.extra or {})
+        return settings
+
+    def get(self, setting_name: str) -> Any:
+        if setting_name in self.FIELDS:
+            return getattr(self, setting_name)
+
+        return self.extra.get(setting_name) if self.extra else None
+
+
+class GuildSettings:
+    """
+    Compact form of the settings of a guild document.
+    """
+    __slots__ = ("default", "channels")
+
+    def __init__(self, default: Optional[ScopeSettings] = None, channels: Optional[Dict[int, ScopeSettings]] = None):
+        self.default = default
+        self.channels = channels or {}
+
+    @classmethod
+    def from_document(cls, document: Dict) -> "GuildSettings":
+        default = None
+        channels = {}
+        for scope, settings in document.get("settings", {}).items():
+            if scope == "default":
+                default = ScopeSettings.from_dict(settings)
+            else:
+                channels[int(scope)] = ScopeSettings.from_dict(settings)
+
+        return cls(default, channels)
+
+    def to_document(self, guild_id: int) -> Dict:
+        settings = {
+            str(channel_id): scope_settings.to_dict()
+            for channel_id, scope_settings in self.channels.items()}
+        if self.default:
+            settings["default"] = self.default.to_dict()
+
+        return {"_id": str(guild_id), "settings": settings}
+
+    def get(self, setting_name: str, channel_id: Optional[int] = None) -> Any:
+        """
+        Get the setting of the channel, or of the server default if the channel has none.
+        :param channel_id: None - If wants to get the server default setting
+        :return: The setting value, None if not set.
+        """
+        if channel_id:
+            channel_settings = self.channels.get(channel_id)
+            if channel_settings:
+                value = channel_settings.get(setting_name)
+                if value is not None:
+                    return value
+
+        if self.default:
+            return self.default.get(setting_name)
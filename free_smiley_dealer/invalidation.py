@@ -0,0 +1,138 @@
+import asyncio
+import datetime
+import logging
+from typing import *
+
+from pymongo.errors import OperationFailure
+
+from database import Database
+
+# Constants
+# Error codes of change streams not being supported by the server (standalone servers)
+CHANGE_STREAMS_UNSUPPORTED_CODES = (40573, 40324)
+WATCHED_COLLECTIONS = ("guilds", "configurations")
+POLL_INTERVAL = 10
+# Poll intervals the guilds polls overlap by, for writes that become visible after their stamp was polled
+POLL_OVERLAP_INTERVALS = 2
+# Stamp of a guilds collection that was never updated, stamps before it are still valid dates
+NO_UPDATE = datetime.datetime(1970, 1, 1)
+RETRY_INTERVAL = 5
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidationFeed:
+    """
+    Keeps the caches of this process in sync with changes made by other processes.
+    Changed guilds are evicted from cache, and changed configurations are reloaded.
+
+    Uses a change stream on replica sets. Standalone servers don't support change streams,
+    so changes are polled instead: guilds by their indexed `updated_at` stamp, and configurations by comparison.
+    Change stream events of the writes of this process are skipped, its cache already has them.
+    Polling can't tell whose write came last when several processes write a guild between polls,
+    so it evicts the guilds this process wrote too, at the cost of a query after every flush.
+    Checked against a local single node replica set by benchmarks/check_invalidation.py.
+    """
+
+    def __init__(self, db: Database, *, poll_interval: float = POLL_INTERVAL):
+        self.db = db
+        self.poll_interval = poll_interval
+
+    async def run(self):
+        use_change_stream = True
+        while True:
+            try:
+                if use_change_stream:
+                    await self.watch()
+                else:
+                    await self.poll()
+            except Exception as e:
+                # Any error is retried, even a deleted configuration, or the caches would stop being synced
+                if use_change_stream and isinstance(e, OperationFailure) and e.code in CHANGE_STREAMS_UNSUPPORTED_CODES:
+                    logger.info("Change streams are not supported by the database, polling for changes.")
+                    use_change_stream = False
+                    continue
+
+                logger.exception("Watching for database changes failed, retrying.")
+
+                # Changes might have been missed
+                self.db.invalidate_all_guilds()
+                await asyncio.sleep(RETRY_INTERVAL)
+
+    async def watch(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": WATCHED_COLLECTIONS}}}]
+        async with self.db.mongo_db.watch(pipeline) as change_stream:
+            async for change in change_stream:
+                await self.handle_change(change)
+
+    async def handle_change(self, change: Dict[str, Any]):
+        """
+        Apply a change stream event to the caches.
+        """
+        operation_type = change["operationType"]
+        if operation_type not in ("insert", "update", "replace", "delete"):
+            # Collection or database dropped or renamed
+            self.db.invalidate_all_guilds()
+            await self.db.update_configurations()
+            return
+
+        collection_name = change["ns"]["coll"]
+        document_id = change["documentKey"]["_id"]
+        if collection_name == "guilds":
+            if not self._is_own_write(change):
+                self.db.invalidate_guild(int(document_id))
+        elif collection_name == "configurations":
+            logger.info(f"Configuration `{document_id}` changed, reloading configurations.")
+            await self.db.update_configurations()
+
+    def _is_own_write(self, change: Dict[str, Any]) -> bool:
+        if change["operationType"] == "update":
+            fields = change["updateDescription"]["updatedFields"]
+        else:
+            # Inserted by an upsert
+            fields = change.get("fullDocument") or {}
+        return self.db.is_own_write(fields.get("updated_by"))
+
+    async def poll(self):
+        # Without the index every poll scans and sorts the whole collection. Creating an existing index does nothing
+        await self.db.mongo_db["guilds"].create_index("updated_at")
+
+        # Writes are stamped when they run rather than when they're committed, so a write stamped before
+        # the last stamp seen may only be visible later. Polls overlap to see it, and skip the updates seen already
+        overlap = datetime.timedelta(seconds=POLL_OVERLAP_INTERVALS * self.poll_interval)
+        last_update = await self._get_last_guild_update()
+        seen_updates = {
+            (doc["_id"], doc["updated_at"]) async for doc in self._find_guild_updates(last_update - overlap)}
+
+        while True:
+            await asyncio.sleep(self.poll_interval)
+
+            # Configurations
+            configurations = await self.db.fetch_configurations()
+            if configurations != (self.db.static_data, self.db.config):
+                logger.info("Configurations changed, reloading configurations.")
+                self.db.apply_configurations(*configurations)
+
+            # Guilds
+            since = last_update - overlap
+            seen_updates = {update for update in seen_updates if update[1] >= since}
+            async for doc in self._find_guild_updates(since):
+                update = (doc["_id"], doc["updated_at"])
+                if update in seen_updates:
+                    continue
+
+                seen_updates.add(update)
+                last_update = max(last_update, doc["updated_at"])
+                self.db.invalidate_guild(int(doc["_id"]))
+
+    def _find_guild_updates(self, since: datetime.datetime):
+        return self.db.mongo_db["guilds"].find({"updated_at": {"$gte": since}}, {"updated_at": 1})
+
+    async def _get_last_guild_update(self) -> datetime.datetime:
+        last_updated_docs = await self.db.mongo_db["guilds"].find(
+            {"updated_at": {"$exists": True}},
+            {"updated_at": 1}).sort("updated_at", -1).limit(1).to_list(None)
+        if not last_updated_docs:
+            return NO_UPDATE
+
+        return last_updated_docs[0]["updated_at"]
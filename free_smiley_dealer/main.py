@@ -1,28 +1,46 @@
 import asyncio
 import logging
+import queue
+import signal
 import sys
+import time
 from logging.handlers import RotatingFileHandler
+from typing import Optional
 
 import discord
 import environs
-import nest_asyncio
 from motor.motor_asyncio import AsyncIOMotorClient
 
 from cogs.smileydealer import FreeSmileyDealerCog
-from database import Database
+from cluster import ClusterSupervisor, ClusterWorker, fetch_recommended_shard_count
+from database import Database, GUILD_CACHE_SIZE, GUILD_CACHE_TTL
+import metrics
 from extensions import *
+from outbound import OutboundScheduler, OUTBOUND_MAX_AGE, OUTBOUND_MAX_DEPTH
+from query_tracing import TracedDatabase
 
-nest_asyncio.apply()
+LOG_FORMAT = "**{levelname}:** *{asctime}*\n{message}"
+LOG_DATE_FORMAT = "%d-%m-%Y %H:%M:%S"
 
 
-async def main():
+async def main(worker: Optional[ClusterWorker] = None):
+    """
+    :param worker: The part of the cluster to run in this process, all of the shards if not given
+    """
+    started_at = time.perf_counter()
     env = environs.Env()
     env.read_env()
 
-    logging_handlers = [
+    # Console and file output is done by a listener thread, the event loop only enqueues records
+    log_queue = queue.Queue(env.int('LOG_QUEUE_SIZE', LOG_QUEUE_SIZE))
+    log_listener = DrainingQueueListener(
+        log_queue,
         logging.StreamHandler(sys.stdout),
-        RotatingFileHandler("log.txt", maxBytes=100_000, backupCount=1)
-    ]
+        RotatingFileHandler(f"log.{worker.index}.txt" if worker else "log.txt", maxBytes=100_000, backupCount=1)
+    )
+    log_listener.start()
+
+    logging_handlers = [DroppingQueueHandler(log_queue)]
     if log_channel := env.int('LOG_CHANNEL', None):
         discord_log_handler = DiscordChannelLoggingHandler(log_channel)
         logging_handlers.append(discord_log_handler)
@@ -31,8 +49,8 @@ async def main():
     logging.basicConfig(
         level=logging.INFO,
         handlers=logging_handlers,
-        datefmt="%d-%m-%Y %H:%M:%S",
-        format="**{levelname}:** *{asctime}*\n{message}",
+        datefmt=LOG_DATE_FORMAT,
+        format=LOG_FORMAT,
         style="{"
     )
     logger = logging.getLogger(__name__)
@@ -53,24 +71,82 @@ async def main():
     )
 
     mongodb_database = mongodb_client[env('MONGODB_DB_NAME')]
-    database = Database(mongodb_database)
+    if env.bool('QUERY_TRACING', False):
+        # Count queries by the message or command that made them, see the "queries" log shortcut
+        mongodb_database = TracedDatabase(mongodb_database)
+    database = Database(
+        mongodb_database,
+        cache_size=env.int('GUILD_CACHE_SIZE', GUILD_CACHE_SIZE),
+        cache_ttl=env.float('GUILD_CACHE_TTL', GUILD_CACHE_TTL))
     logger.info('Set up mongodb client successfully.')
 
     intents = discord.Intents.default()
     intents.message_content = True
 
-    bot = BasicBot(intents, database)
+    outbound = OutboundScheduler(
+        max_depth=env.int('OUTBOUND_MAX_DEPTH', OUTBOUND_MAX_DEPTH),
+        max_age=env.float('OUTBOUND_MAX_AGE', OUTBOUND_MAX_AGE))
+
+    bot = BasicBot(intents, database, outbound=outbound, cluster=worker)
+
+    if metrics_port := env.int('METRICS_PORT', None):
+        # Cluster workers serve on consecutive ports
+        metrics.enable()
+        await metrics.serve(metrics_port + (worker.index if worker else 0), env.str('METRICS_HOST', metrics.METRICS_HOST))
+
     if log_channel:
         discord_log_handler.bot = bot
     logger.info('Added discord logging handler.')
 
-    try:
-        await bot.add_cog(FreeSmileyDealerCog(bot, database))
+    async def log_time_to_first_response():
+        await outbound.first_sent.wait()
+        logger.info(f"Sent the first response {time.perf_counter() - started_at:.2f}s after starting up.")
 
-        bot.run(env.str('DISCORD_TOKEN'))
+    try:
+        async with bot:
+            # Loading the configurations, logging in and reading the smiley emojis snapshot don't depend on each other
+            _, _, smiley_emojis_snapshot = await asyncio.gather(
+                database.update_configurations(),
+                bot.login(env.str('DISCORD_TOKEN')),
+                asyncio.to_thread(FreeSmileyDealerCog.read_smiley_emojis_snapshot))
+            logger.info(f"Loaded configurations and logged in after {time.perf_counter() - started_at:.2f}s.")
+
+            # Building the smiley index needs the configurations
+            await bot.add_cog(FreeSmileyDealerCog(bot, database, smiley_emojis_snapshot=smiley_emojis_snapshot))
+
+            # Referenced until shutdown, the loop only keeps weak references to tasks
+            logging_first_response = asyncio.create_task(log_time_to_first_response())
+            try:
+                await bot.connect()
+            finally:
+                logging_first_response.cancel()
     except Exception as e:
         logger.exception(e)
+    finally:
+        # Write out the queued records
+        log_listener.stop()
+
+
+def run_worker(worker: ClusterWorker):
+    # The supervisor stops workers with SIGTERM, close the bot like on Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    asyncio.run(main(worker))
+
+
+def run():
+    env = environs.Env()
+    env.read_env()
+
+    workers_count = env.int('CLUSTER_WORKERS', 1)
+    if workers_count <= 1:
+        asyncio.run(main())
+        return
+
+    # noinspection PyArgumentList
+    logging.basicConfig(level=logging.INFO, datefmt=LOG_DATE_FORMAT, format=LOG_FORMAT, style="{")
+    shard_count = env.int('SHARD_COUNT', None) or asyncio.run(fetch_recommended_shard_count(env.str('DISCORD_TOKEN')))
+    ClusterSupervisor(run_worker, shard_count, workers_count).run()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    run()
@@ -0,0 +1,192 @@
+import bisect
+import functools
+import logging
+import time
+from typing import *
+
+from aiohttp import web
+
+# Defaults
+METRICS_HOST = "127.0.0.1"
+
+# Seconds, from a tenth of a millisecond up to the timeouts of discord requests
+DEFAULT_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+logger = logging.getLogger(__name__)
+
+# Metrics record nothing until enabled, so instrumented code costs a flag check
+_enabled = False
+_registry: Dict[str, "Metric"] = {}
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def _format_labels(label_names: Sequence[str], label_values: Sequence[Any], **extra_labels) -> str:
+    labels = [*zip(label_names, label_values), *extra_labels.items()]
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Metric:
+    """
+    Metric in the Prometheus text format, registered by its name.
+    Registering a metric with the name of another replaces it.
+    """
+    type_name: str
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        _registry[name] = self
+
+    def _get_label_values(self, labels: Dict[str, Any]) -> Tuple:
+        return tuple(labels[name] for name in self.label_names)
+
+    def render_samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type_name}"
+        yield from self.render_samples()
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        if not _enabled:
+            return
+
+        label_values = self._get_label_values(labels)
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render_samples(self) -> Iterable[str]:
+        for label_values, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.label_names, label_values)} {value}"
+
+
+class Gauge(Metric):
+    """
+    Gauge of a value collected when the metrics are rendered.
+    """
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, collect: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.collect = collect
+
+    def render_samples(self) -> Iterable[str]:
+        yield f"{self.name} {self.collect()}"
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (), *,
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+        # Counts of observations per bucket, and the last count of the observations above all buckets
+        self._counts: Dict[Tuple, List[int]] = {}
+        self._sums: Dict[Tuple, float] = {}
+
+    def observe(self, value: float, **labels):
+        if not _enabled:
+            return
+
+        label_values = self._get_label_values(labels)
+        counts = self._counts.get(label_values)
+        if counts is None:
+            counts = self._counts[label_values] = [0] * (len(self.buckets) + 1)
+            self._sums[label_values] = 0
+
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[label_values] += value
+
+    def time(self, **labels) -> "_Timer":
+        """
+        Time an async function when used as a decorator, or a block when used as a context manager.
+        """
+        return _Timer(self, labels)
+
+    def render_samples(self) -> Iterable[str]:
+        for label_values, counts in self._counts.items():
+            cumulative_count = 0
+            for bucket, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative_count += count
+                labels = _format_labels(self.label_names, label_values, le=bucket)
+                yield f"{self.name}_bucket{labels} {cumulative_count}"
+
+            labels = _format_labels(self.label_names, label_values)
+            yield f"{self.name}_sum{labels} {self._sums[label_values]}"
+            yield f"{self.name}_count{labels} {cumulative_count}"
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "_start")
+
+    def __init__(self, histogram: Histogram, labels: Dict[str, Any]):
+        self.histogram = histogram
+        self.labels = labels
+        self._start = None
+
+    def __enter__(self):
+        if _enabled:
+            self._start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._start is not None:
+            self.histogram.observe(time.perf_counter() - self._start, **self.labels)
+            self._start = None
+
+    def __call__(self, func: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+        histogram, labels = self.histogram, self.labels
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not _enabled:
+                return await func(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+
+        return wrapper
+
+
+def render() -> str:
+    return "\n".join(line for metric in _registry.values() for line in metric.render()) + "\n"
+
+
+async def serve(port: int, host: str = METRICS_HOST) -> web.AppRunner:
+    """
+    Serve the metrics in the Prometheus text format on /metrics.
+    """
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics.")
+    return runner
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import suppress
+from typing import *
+
+import discord
+
+import metrics
+
+# Defaults
+OUTBOUND_MAX_DEPTH = 5
+OUTBOUND_MAX_AGE = 30
+# Discord's message character limit
+OUTBOUND_MAX_TEXT_LENGTH = 2000
+
+logger = logging.getLogger(__name__)
+
+# Metrics
+DROPPED_RESPONSES = metrics.Counter(
+    "smiley_dealer_outbound_dropped_total", "Responses dropped from the outbound queues, by reason.", ("reason",))
+MERGED_RESPONSES = metrics.Counter(
+    "smiley_dealer_outbound_merged_total", "Text responses sent in the message of an earlier response.")
+
+
+class OutboundScheduler:
+    """
+    Sends responses through a bounded queue per channel, one response at a time.
+    When a channel is flooded, responses that waited too long are dropped instead of being sent late,
+    and the oldest responses are dropped when the queue is full.
+    Text responses queued one after another are merged, and sent in one message while it fits.
+    Responses to commands have priority: while commands run in a channel, its queue waits.
+    """
+
+    def __init__(self, *, max_depth: int = OUTBOUND_MAX_DEPTH, max_age: float = OUTBOUND_MAX_AGE,
+                 max_text_length: int = OUTBOUND_MAX_TEXT_LENGTH):
+        """
+        :param max_depth: Count of responses a channel can queue
+        :param max_age: Seconds since its message after which a response is dropped
+        :param max_text_length: Length of the merged text of text responses
+        """
+        self.max_depth = max_depth
+        self.max_age = max_age
+        self.max_text_length = max_text_length
+
+        # Queued responses, their text is None unless they're text responses
+        self._queues: Dict[int, Deque[Tuple[float, Callable[..., Awaitable], Optional[str]]]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._running_commands: Dict[int, int] = {}
+        self._commands_finished: Dict[int, asyncio.Event] = {}
+
+        self.sent_count = 0
+        self.first_sent = asyncio.Event()
+        self.dropped_stale_count = 0
+        self.dropped_overflow_count = 0
+        self.merged_count = 0
+        self.max_depth_seen = 0
+
+    def submit(self, channel_id: int, send: Callable[[], Awaitable], *, created_at: Optional[float] = None):
+        """
+        Queue a response in the channel.
+        :param send: Function that sends the response
+        :param created_at: Timestamp the age of the response is counted from, now by default
+        """
+        self._submit(channel_id, send, None, created_at)
+
+    def submit_text(self, channel_id: int, text: str, send_text: Callable[[str], Awaitable], *,
+                    created_at: Optional[float] = None):
+        """
+        Queue a response that is a message of text in the channel.
+        :param send_text: Function that sends text in the channel, the text of the next text responses may be merged in
+        :param created_at: Timestamp the age of the response is counted from, now by default
+        """
+        self._submit(channel_id, send_text, text, created_at)
+
+    def _submit(self, channel_id: int, send: Callable[..., Awaitable], text: Optional[str],
+                created_at: Optional[float]):
+        queue = self._queues.setdefault(channel_id, deque())
+        if len(queue) >= self.max_depth:
+            queue.popleft()
+            self.dropped_overflow_count += 1
+            DROPPED_RESPONSES.inc(reason="overflow")
+
+        queue.append((created_at if created_at is not None else time.time(), send, text))
+        self.max_depth_seen = max(self.max_depth_seen, len(queue))
+
+        if channel_id not in self._workers:
+            self._workers[channel_id] = asyncio.create_task(self._send_queued(channel_id))
+
+    def command_started(self, channel_id: int):
+        self._running_commands[channel_id] = self._running_commands.get(channel_id, 0) + 1
+        self._commands_finished.setdefault(channel_id, asyncio.Event()).clear()
+
+    def command_finished(self, channel_id: int):
+        running_commands = self._running_commands.get(channel_id, 0) - 1
+        if running_commands > 0:
+            self._running_commands[channel_id] = running_commands
+            return
+
+        self._running_commands.pop(channel_id, None)
+        commands_finished = self._commands_finished.pop(channel_id, None)
+        if commands_finished:
+            commands_finished.set()
+
+    async def _wait_for_commands(self, channel_id: int):
+        commands_finished = self._commands_finished.get(channel_id)
+        if commands_finished:
+            # Commands waiting for user input mustn't hold the queue forever
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(commands_finished.wait(), self.max_age)
+
+    async def _send_queued(self, channel_id: int):
+        queue = self._queues[channel_id]
+        try:
+            while queue:
+                await self._wait_for_commands(channel_id)
+
+                created_at, send, text = queue.popleft()
+                if self._is_stale(created_at):
+                    continue
+
+                try:
+                    if text is None:
+                        await send()
+                    else:
+                        await send(self._merge_queued_texts(queue, text))
+                    self.sent_count += 1
+                    self.first_sent.set()
+                except discord.Forbidden:
+                    # Missing permissions to answer in this channel
+                    pass
+                except Exception:
+                    logger.exception(f"Failed sending response in channel {channel_id}.")
+        finally:
+            del self._workers[channel_id]
+            if not queue:
+                del self._queues[channel_id]
+
+    def _is_stale(self, created_at: float) -> bool:
+        """
+        Check if a response waited too long, and count it as dropped if it did.
+        """
+        if time.time() - created_at <= self.max_age:
+            return False
+
+        self.dropped_stale_count += 1
+        DROPPED_RESPONSES.inc(reason="stale")
+        return True
+
+    def _merge_queued_texts(self, queue: Deque, text: str) -> str:
+        """
+        Take the text responses queued next from the queue, and merge their text into the text while it fits.
+        """
+        while queue and queue[0][2] is not None and len(text) + 1 + len(queue[0][2]) <= self.max_text_length:
+            created_at, _, next_text = queue.popleft()
+            if self._is_stale(created_at):
+                continue
+
+            text += "\n" + next_text
+            self.merged_count += 1
+            MERGED_RESPONSES.inc()
+
+        return text
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "channels": len(self._queues),
+            "queued": sum(map(len, self._queues.values())),
+            "max_depth_seen": self.max_depth_seen,
+            "sent": self.sent_count,
+            "dropped_stale": self.dropped_stale_count,
+            "dropped_overflow": self.dropped_overflow_count,
+            "merged": self.merged_count,
+        }
+
@@ -0,0 +1,144 @@
+import contextvars
+import logging
+from collections import Counter
+from contextlib import contextmanager
+from typing import *
+
+from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
+
+# Constants
+# Collection methods that make a round-trip to mongodb
+QUERY_METHODS = frozenset((
+    "find", "find_one", "aggregate", "count_documents",
+    "insert_one", "insert_many", "update_one", "update_many", "replace_one", "delete_one", "delete_many",
+    "bulk_write", "find_one_and_update", "find_one_and_replace", "find_one_and_delete", "create_index"))
+UNTRACED_PATH = "untraced"
+
+logger = logging.getLogger(__name__)
+
+
+class QueryScope:
+    """
+    The queries made while handling something, a message or a command.
+    Tasks started in the scope inherit it, so queries shared by concurrent reads count for the first reader.
+    Queries of a nested scope count for the enclosing scopes too.
+    Queries are counted rather than listed, scopes of background tasks live as long as the process.
+    """
+    __slots__ = ("path", "tag", "parent", "queries")
+
+    def __init__(self, path: str, tag: Any = None, parent: Optional["QueryScope"] = None):
+        """
+        :param path: The code path, queries are counted by it
+        :param tag: What triggered the path, like a message id
+        :param parent: The enclosing scope
+        """
+        self.path = path
+        self.tag = tag
+        self.parent = parent
+        self.queries: Counter = Counter()
+
+    @property
+    def queries_count(self) -> int:
+        return sum(self.queries.values())
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+_current_scope: contextvars.ContextVar[Optional[QueryScope]] = contextvars.ContextVar("query_scope", default=None)
+
+# Counts of the traced paths, and of the queries by path and query
+scopes_counts: Counter = Counter()
+queries_counts: Dict[str, Counter] = {}
+
+
+@contextmanager
+def trace_queries(path: str, tag: Any = None) -> Iterator[QueryScope]:
+    """
+    Count the queries made in the block under the path.
+    """
+    scope = QueryScope(path, tag, _current_scope.get())
+    token = _current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_scope.reset(token)
+        scopes_counts[path] += 1
+
+
+@contextmanager
+def assert_query_budget(max_queries: int, path: str = "budget") -> Iterator[QueryScope]:
+    """
+    Fail if the block makes more than `max_queries` queries. Only queries of traced databases are counted.
+    Example:
+        with assert_query_budget(0):
+            await cog.on_message(message)
+    """
+    with trace_queries(path) as scope:
+        yield scope
+
+    if scope.queries_count > max_queries:
+        raise QueryBudgetExceeded(
+            f"{path} made {scope.queries_count} queries, over its budget of {max_queries}: {dict(scope.queries)}")
+
+
+def record_query(collection_name: str, method_name: str):
+    query = f"{collection_name}.{method_name}"
+    scope = _current_scope.get()
+    path = scope.path if scope else UNTRACED_PATH
+    queries_counts.setdefault(path, Counter())[query] += 1
+    logger.debug(f"Query {query} by {path}" + (f" ({scope.tag})" if scope and scope.tag is not None else ""))
+
+    while scope:
+        scope.queries[query] += 1
+        scope = scope.parent
+
+
+def query_stats() -> Dict[str, Dict[str, Any]]:
+    """
+    :return: Per path, how many times it was traced, its queries, and its queries per trace.
+    """
+    return {
+        path: {
+            "traced": scopes_counts[path],
+            "queries": dict(path_queries_counts),
+            "queries_per_trace": sum(path_queries_counts.values()) / scopes_counts[path] if scopes_counts[path] else None,
+        }
+        for path, path_queries_counts in queries_counts.items()}
+
+
+class TracedCollection:
+    """
+    Motor collection whose queries are recorded in the current query scope.
+    """
+
+    def __init__(self, collection: AsyncIOMotorCollection, name: str):
+        self._collection = collection
+        self._name = name
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self._collection, name)
+        if name not in QUERY_METHODS:
+            return attribute
+
+        def traced(*args, **kwargs):
+            record_query(self._name, name)
+            return attribute(*args, **kwargs)
+
+        return traced
+
+
+class TracedDatabase:
+    """
+    Motor database whose collections record their queries in the current query scope.
+    """
+
+    def __init__(self, mongo_db: AsyncIOMotorDatabase):
+        self._mongo_db = mongo_db
+
+    def __getitem__(self, name: str) -> TracedCollection:
+        return TracedCollection(self._mongo_db[name], name)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._mongo_db, name)